@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Compares the old os.walk based chown with utils.chown_tree on a synthetic tree.
+# Runs as any user: everything is chowned to the current uid/gid, so the first pass
+# measures the walk and the later passes measure the "already owned" fast path.
+
+import click
+import os
+import shutil
+import tempfile
+import time
+
+from thalamus.utils import chown_tree
+
+def walk_chown(path, uid, gid):
+    for root, dirs, files in os.walk(path):
+        for d in dirs:
+            os.chown(os.path.join(root, d), uid, gid)
+        for f in files:
+            os.chown(os.path.join(root, f), uid, gid)
+    os.chown(path, uid, gid)
+
+def make_tree(root, dirs, files_per_dir, depth):
+    count = 0
+    for i in range(dirs):
+        d = os.path.join(root, f"d{i}", *[f"level{n}" for n in range(depth)])
+        os.makedirs(d)
+        for j in range(files_per_dir):
+            with open(os.path.join(d, f"f{j}"), "w"):
+                pass
+        count += files_per_dir + depth + 1
+    os.symlink(os.path.join(root, "d0"), os.path.join(root, "link"))
+    return count + 1
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+@click.command()
+@click.option("--dirs", default=200, show_default=True)
+@click.option("--files-per-dir", default=200, show_default=True)
+@click.option("--depth", default=3, show_default=True)
+@click.option("--workers", default=8, show_default=True)
+@click.option("--repeat", default=3, show_default=True)
+def main(dirs, files_per_dir, depth, workers, repeat):
+    uid, gid = os.getuid(), os.getgid()
+    root = tempfile.mkdtemp(prefix="thalamus-chown-bench-")
+    try:
+        entries = make_tree(root, dirs, files_per_dir, depth)
+        click.echo(f"{entries} entries under {root}")
+        candidates = {
+            "os.walk + chown": lambda: walk_chown(root, uid, gid),
+            "chown_tree": lambda: chown_tree(root, uid, gid),
+            f"chown_tree workers={workers}": lambda: chown_tree(root, uid, gid, workers=workers),
+        }
+        for name, fn in candidates.items():
+            best = min(timed(fn) for _ in range(repeat))
+            click.echo(f"{name:<28} {best * 1000:9.1f} ms  {entries / best:12.0f} entries/s")
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
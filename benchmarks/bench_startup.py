@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# Tracks installer startup cost: the cumulative `python -X importtime` time of
+# thalamus.main, the slowest imports under it, and the wall time of `--help`.
+# Use --max-import-ms to fail (exit 1) when the import time regresses.
+
+import click
+import statistics
+import subprocess
+import sys
+import time
+
+def import_times():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import thalamus.main"],
+        capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        if self_us.isdigit():
+            times[name] = (int(self_us), int(cumulative_us))
+    return times
+
+def help_wall_time():
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", "from thalamus.main import main; main(['--help'])"],
+        capture_output=True, check=True
+    )
+    return time.perf_counter() - started
+
+@click.command()
+@click.option("--repeat", default=5, show_default=True)
+@click.option("--top", default=10, show_default=True, help="How many of the slowest imports to show")
+@click.option("--max-import-ms", type=float, help="Exit with an error if importing thalamus.main takes longer than this")
+def main(repeat, top, max_import_ms):
+    runs = [import_times() for _ in range(repeat)]
+    import_ms = statistics.median(run["thalamus.main"][1] for run in runs) / 1000
+    help_ms = statistics.median(help_wall_time() for _ in range(repeat)) * 1000
+
+    click.echo(f"import thalamus.main  {import_ms:8.1f} ms (median of {repeat}, cumulative)")
+    click.echo(f"install-cortex --help {help_ms:8.1f} ms (median of {repeat}, wall clock)")
+    click.echo("Slowest imports by self time (last run):")
+    for name, (self_us, cumulative_us) in sorted(runs[-1].items(), key=lambda item: -item[1][0])[:top]:
+        click.echo(f"  {self_us / 1000:7.1f} ms  {name.strip()}")
+
+    if max_import_ms is not None and import_ms > max_import_ms:
+        click.echo(click.style("Error: ", fg="red", bold=True) + f"import took {import_ms:.1f} ms, limit is {max_import_ms} ms")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import itertools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from thalamus.bench import percentile, run_benchmark
+
+class StandInSite(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    counter = itertools.count()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(0.5)
+        if self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(b"5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n")
+            return
+        # every other request to /flaky fails
+        status = 503 if self.path == "/down" or (self.path == "/flaky" and next(self.counter) % 2) else 200
+        body = self.headers["Host"].encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StandInServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # timed out clients hang up before /slow answers
+        pass
+
+@pytest.fixture
+def port():
+    server = StandInServer(("127.0.0.1", 0), StandInSite)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StandInSite.counter = itertools.count()
+    yield server.server_port
+    server.shutdown()
+    server.server_close()
+
+def test_status_counts_and_error_rate(port):
+    up, down = run_benchmark(
+        [("frontend.local", "127.0.0.1", port, "/"), ("backend.local", "127.0.0.1", port, "/down")],
+        rate=100, duration=0.2, connections=4
+    )
+    assert (up["host"], up["requests"], up["statuses"], up["errors"], up["error_rate"]) == ("frontend.local", 20, {"200": 20}, 0, 0)
+    assert up["bytes"] == 20 * len("frontend.local")
+    assert (down["requests"], down["statuses"], down["errors"], down["error_rate"]) == (20, {"503": 20}, 20, 1.0)
+    assert down["throughput_rps"] == 0
+
+def test_partial_errors(port):
+    result, = run_benchmark([("backend.local", "127.0.0.1", port, "/flaky")], rate=100, duration=0.2, connections=1)
+    assert result["statuses"] == {"200": 10, "503": 10}
+    assert result["error_rate"] == 0.5
+
+def test_chunked_responses_keep_the_connection(port):
+    result, = run_benchmark([("frontend.local", "127.0.0.1", port, "/chunked")], rate=100, duration=0.1, connections=1)
+    assert result["statuses"] == {"200": 10}
+    assert result["bytes"] == 10 * len("hello world")
+
+def test_timeouts_are_errors(port):
+    result, = run_benchmark([("backend.local", "127.0.0.1", port, "/slow")], rate=20, duration=0.1, timeout=0.1)
+    assert result["exceptions"] == {"Timeout": 2}
+    assert result["error_rate"] == 1.0
+    assert result["latency_ms"]["p50"] is None
+
+def test_latency_percentiles(port):
+    result, = run_benchmark([("frontend.local", "127.0.0.1", port, "/")], rate=200, duration=0.25)
+    latency = result["latency_ms"]
+    assert 0 < latency["p50"] <= latency["p95"] <= latency["p99"] <= latency["max"]
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert [percentile(values, fraction) for fraction in (0.5, 0.95, 0.99, 1.0)] == [50, 95, 99, 100]
+    assert percentile([7], 0.99) == 7
+    assert percentile([], 0.5) is None
@@ -0,0 +1,105 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from thalamus.fleet import Fleet, SSHHost
+
+# stands in for ssh (and k0s, for the tokens): records what it was asked to run and exits
+# with the status in STUB_EXIT, so nothing ever leaves this machine
+STUB = """#!{python}
+import json, os, sys
+with open(os.environ["STUB_LOG"], "a") as log:
+    log.write(json.dumps({{"argv": [os.path.basename(sys.argv[0])] + sys.argv[1:], "input": sys.stdin.read()}}) + "\\n")
+if sys.argv[1:2] == ["token"]:
+    print("token-" + sys.argv[3].split("=")[1])
+status = int(os.environ.get("STUB_EXIT", "0"))
+if status:
+    print("connection refused", file=sys.stderr)
+sys.exit(status)
+"""
+
+@pytest.fixture
+def calls(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name in ("ssh", "k0s"):
+        path = bin_dir / name
+        path.write_text(STUB.format(python=sys.executable))
+        path.chmod(0o755)
+    log = tmp_path / "calls.jsonl"
+    monkeypatch.setenv("PATH", f"{bin_dir}:/usr/bin:/bin")
+    monkeypatch.setenv("STUB_LOG", str(log))
+
+    def read():
+        return [json.loads(line) for line in log.read_text().splitlines()] if log.exists() else []
+    return read
+
+def test_run_uses_sudo_for_non_root_users(calls):
+    SSHHost("node-1", user="ubuntu", port=2222).run("echo 'hi there'", input=b"data")
+    call, = calls()
+    assert call["argv"][0] == "ssh"
+    assert call["argv"][-3:] == ["ubuntu@node-1", "--", "sudo -n sh -c 'echo '\"'\"'hi there'\"'\"''"]
+    assert "ControlMaster=auto" in call["argv"] and "2222" in call["argv"]
+    assert call["input"] == "data"
+
+def test_run_as_root_runs_the_command_directly(calls):
+    SSHHost("node-1", user="root").run("k0s status")
+    assert calls()[0]["argv"][-1] == "k0s status"
+
+def test_run_failure_raises_with_output(calls, monkeypatch):
+    monkeypatch.setenv("STUB_EXIT", "255")
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        SSHHost("node-1").run("true")
+    assert error.value.returncode == 255
+    assert b"connection refused" in error.value.output
+
+def test_from_inventory(tmp_path):
+    inventory = tmp_path / "inventory.yaml"
+    inventory.write_text(
+        "user: ubuntu\n"
+        "key: ~/.ssh/cluster\n"
+        "controllers: [c1]\n"
+        "workers:\n"
+        "- host: w1\n"
+        "  user: root\n"
+        "  port: 2200\n"
+    )
+    fleet = Fleet.from_inventory(str(inventory), home_dir="/home/me")
+    try:
+        (controller,), (worker,) = fleet.controllers, fleet.workers
+        assert (str(controller), controller.key, controller.sudo) == ("ubuntu@c1", "/home/me/.ssh/cluster", True)
+        assert (str(worker), worker.port, worker.sudo) == ("root@w1", 2200, False)
+        assert fleet.node_count == 3
+        assert controller.control_dir == worker.control_dir == fleet.control_dir
+    finally:
+        fleet.close()
+
+def test_join_sends_tokens_over_stdin(calls):
+    fleet = Fleet([SSHHost("c1", user="root")], [SSHHost("w1", user="root")])
+    try:
+        fleet.join()
+    finally:
+        fleet.close()
+    ssh_calls = [call for call in calls() if call["argv"][0] == "ssh" and "-O" not in call["argv"]]
+    tokens = {call["argv"][-3]: call["input"] for call in ssh_calls if call["input"]}
+    assert tokens == {"root@c1": "token-controller", "root@w1": "token-worker"}
+    commands = {call["argv"][-3]: call["argv"][-1] for call in ssh_calls if not call["input"]}
+    assert commands["root@c1"].startswith("k0s install controller --enable-worker --no-taints --token-file")
+    assert commands["root@w1"].startswith("k0s install worker --token-file")
+    argv = " ".join(arg for call in ssh_calls for arg in call["argv"])
+    assert "token-controller" not in argv and "token-worker" not in argv
+
+def test_join_pushes_tuned_config(calls):
+    fleet = Fleet([SSHHost("c1", user="root")], [SSHHost("w1", user="root")])
+    try:
+        fleet.join(files={"/etc/k0s/k0s.yaml": "kind: ClusterConfig\n"}, config_path="/etc/k0s/k0s.yaml", worker_profile="thalamus")
+    finally:
+        fleet.close()
+    ssh_calls = [call for call in calls() if call["argv"][0] == "ssh" and "-O" not in call["argv"]]
+    pushed = {call["argv"][-3] for call in ssh_calls if call["input"] == "kind: ClusterConfig\n"}
+    assert pushed == {"root@c1", "root@w1"}
+    installs = {call["argv"][-3]: call["argv"][-1] for call in ssh_calls if call["argv"][-1].startswith("k0s install")}
+    assert "--config /etc/k0s/k0s.yaml --profile thalamus" in installs["root@c1"]
+    assert "--config" not in installs["root@w1"] and "--profile thalamus" in installs["root@w1"]
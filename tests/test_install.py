@@ -0,0 +1,79 @@
+import json
+import os
+import pwd
+import shutil
+from types import SimpleNamespace
+
+import pytest
+from click.testing import CliRunner
+
+from thalamus import main as cli
+from thalamus.kubernetes import Kubernetes
+from thalamus.sudo import Sudo
+from thalamus.values import Values
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXTERNAL_IP = "203.0.113.10"
+ARGS = [
+    "--accept-risk", "--frontend", "cortex.example.com", "--backend", "api.cortex.example.com",
+    "--cortex-license", "license-jwt", "--github-pat", "ghp_token",
+]
+# what an earlier `--profile auto` or fleet install recorded
+SIZED_VALUES = {
+    "app": {
+        "springProfilesActive": "dev",
+        "service": {"type": "NodePort"},
+        "backend": {"replicaCount": 3, "jvmConfiguration": {"javaOpts": "-Xms2048m -Xmx9216m"}},
+        "worker": {"replicaCount": 3},
+        "hostnames": {"backend": "api.cortex.example.com", "frontend": "cortex.example.com", "protocol": "http"},
+    }
+}
+
+@pytest.fixture
+def installed(tmp_path, monkeypatch):
+    # a finished install in a scratch home directory, with helm and the cluster answered from memory
+    home = tmp_path / "home"
+    (home / "cortex").mkdir(parents=True)
+    (home / ".thalamus").mkdir()
+    values_path = home / "cortex" / "values.yaml"
+    shutil.copy(os.path.join(REPO, "values.yaml"), values_path)
+    (home / ".thalamus" / "install.json").write_text(json.dumps({
+        "frontend": "cortex.example.com", "backend": "api.cortex.example.com",
+        "frontend_ip": "10.0.0.1", "backend_ip": "10.0.0.2", "external_ip": EXTERNAL_IP,
+        "protocol": "http", "tls_cert": None, "tls_key": None, "profile": "auto", "values": SIZED_VALUES,
+    }))
+    release_values = json.loads(json.dumps(Values().render_values_yaml(str(values_path), SIZED_VALUES)))
+
+    monkeypatch.setattr(pwd, "getpwuid", lambda uid: SimpleNamespace(pw_dir=str(home)))
+    monkeypatch.setattr(os, "geteuid", lambda: 0)
+    monkeypatch.setenv("SUDO_UID", str(os.getuid()))
+    monkeypatch.setenv("SUDO_GID", str(os.getgid()))
+    for key, value in (
+        (("external_ip",), EXTERNAL_IP),
+        (("dns", "cortex.example.com"), EXTERNAL_IP),
+        (("dns", "api.cortex.example.com"), EXTERNAL_IP),
+        (("github_pat", "ghp_token"), True),
+        (("license", "license-jwt"), {}),
+    ):
+        cli.preflight.remember(key, value)
+    monkeypatch.setattr(Kubernetes, "release_exists", lambda self, release="cortex": True)
+    monkeypatch.setattr(Kubernetes, "get_release_values", lambda self, release="cortex": release_values)
+    monkeypatch.setattr(Kubernetes, "secret_is_current", lambda self, secret: True)
+    monkeypatch.setattr(Kubernetes, "get_service_ips", lambda self, names: ["10.0.0.1", "10.0.0.2"])
+    steps = []
+    monkeypatch.setattr(Sudo, "execute_steps", lambda self, batch: steps.extend(batch))
+    return steps
+
+def test_rerun_keeps_a_sized_install(installed):
+    result = CliRunner().invoke(cli.main, ARGS)
+    assert result.exit_code == 0, result.output
+    assert "upgrading it instead" in result.output
+    assert "Cortex is already up to date" in result.output
+    assert installed == []
+
+def test_rerun_with_an_explicit_profile_reapplies_it(installed):
+    result = CliRunner().invoke(cli.main, ARGS + ["--profile", "demo"])
+    assert result.exit_code == 0, result.output
+    assert "app.backend.replicaCount: 3 -> 1" in result.output
+    assert "app.worker.replicaCount: 3 -> 1" in result.output
+    assert [step["description"] for step in installed] == ["Edit values.yaml", "Upgrade Cortex"]
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from thalamus.journal import StepJournal
+from thalamus.sudo import Sudo
+
+def make_steps(calls, chart="1.0", fail=()):
+    def run(name):
+        def command():
+            if name in fail:
+                raise RuntimeError(f"{name} failed")
+            calls.append(name)
+        return command
+
+    return [
+        {"name": "fetch-chart", "command": run("fetch-chart"), "inputs": [chart], "description": "Fetch chart"},
+        {"name": "edit-values", "command": run("edit-values"), "inputs": [], "description": "Edit values", "depends": ["fetch-chart"]},
+        {"name": "install-nginx", "command": run("install-nginx"), "inputs": [], "description": "Install nginx"},
+        {"name": "install-cortex", "command": run("install-cortex"), "inputs": [], "description": "Install Cortex",
+         "depends": ["edit-values", "install-nginx"]},
+        {"name": "wait", "command": run("wait"), "description": "Wait", "depends": ["install-cortex"], "journal": False},
+    ]
+
+@pytest.fixture
+def run_steps(tmp_path):
+    path = str(tmp_path / ".thalamus" / "journal.json")
+
+    def run(calls, **kwargs):
+        sudo = Sudo(sudo=False, journal=StepJournal(path))
+        sudo.execute_step_graph(make_steps(calls, **kwargs))
+    return run
+
+def test_a_finished_run_is_skipped(run_steps):
+    first, second = [], []
+    run_steps(first)
+    run_steps(second)
+    assert sorted(first) == ["edit-values", "fetch-chart", "install-cortex", "install-nginx", "wait"]
+    # steps with "journal": False always run
+    assert second == ["wait"]
+
+def test_a_failed_run_resumes_at_the_failed_step(run_steps):
+    first, second = [], []
+    with pytest.raises(RuntimeError):
+        run_steps(first, fail=["install-cortex"])
+    run_steps(second)
+    assert "install-cortex" not in first
+    assert second == ["install-cortex", "wait"]
+
+def test_a_changed_step_reruns_everything_after_it(run_steps):
+    first, second = [], []
+    run_steps(first)
+    run_steps(second, chart="2.0")
+    assert second == ["fetch-chart", "edit-values", "install-cortex", "wait"]
+
+def test_string_commands_are_their_own_inputs():
+    step = {"name": "install-cortex", "command": "helm install cortex ./cortex", "inputs": ["ignored"]}
+    assert StepJournal.fingerprint(step) == StepJournal.fingerprint(dict(step, inputs=["other"]))
+    assert StepJournal.fingerprint(step) != StepJournal.fingerprint(dict(step, command="helm upgrade --install cortex ./cortex"))
+    assert StepJournal.fingerprint(step) != StepJournal.fingerprint(step, ["upstream"])
+
+def test_journal_is_saved_and_cleared(tmp_path):
+    path = tmp_path / "journal.json"
+    journal = StepJournal(str(path))
+    journal.mark_complete("fetch-chart", "abc")
+    assert json.loads(path.read_text())["steps"]["fetch-chart"]["fingerprint"] == "abc"
+    assert StepJournal(str(path)).is_complete("fetch-chart", "abc")
+    assert not StepJournal(str(path)).is_complete("fetch-chart", "def")
+    journal.clear()
+    assert StepJournal(str(path)).steps == {}
+
+def test_unreadable_journal_starts_empty(tmp_path):
+    path = tmp_path / "journal.json"
+    path.write_text("{not json")
+    assert StepJournal(str(path)).steps == {}
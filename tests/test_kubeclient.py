@@ -0,0 +1,94 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from thalamus.kubeclient import KubeApiError, KubeClient
+
+class StandInApi(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.requests.append(("GET", self.path, self.headers.get("Authorization"), None))
+        if "watch=true" in self.path:
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for event_type, name in (("ADDED", "a"), ("MODIFIED", "b")):
+                line = json.dumps({"type": event_type, "object": {"metadata": {"name": name}}}).encode() + b"\n"
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path.startswith("/api/v1/nodes"):
+            self.send_json({"items": [{"metadata": {"name": "node-1"}}]})
+        else:
+            self.send_json({"kind": "Status", "message": "secrets \"missing\" not found"}, 404)
+
+    def do_PATCH(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.requests.append(("PATCH", self.path, self.headers["Content-Type"], body))
+        self.send_json(body)
+
+@pytest.fixture
+def client(tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StandInApi.requests = []
+    kube_config = tmp_path / "config"
+    kube_config.write_text(f"""
+apiVersion: v1
+clusters:
+- cluster:
+    server: http://127.0.0.1:{server.server_port}
+  name: local
+contexts:
+- context:
+    cluster: local
+    user: admin
+  name: local
+current-context: local
+users:
+- name: admin
+  user:
+    token: secret-token
+""")
+    with KubeClient(str(kube_config)) as client:
+        yield client
+    server.shutdown()
+    server.server_close()
+
+def test_get(client):
+    assert client.get("/api/v1/nodes")["items"][0]["metadata"]["name"] == "node-1"
+    assert StandInApi.requests[0][2] == "Bearer secret-token"
+
+def test_get_missing_raises_api_error(client):
+    with pytest.raises(KubeApiError) as error:
+        client.get("/api/v1/namespaces/default/secrets/missing")
+    assert error.value.status_code == 404
+    assert "not found" in str(error.value)
+
+def test_apply_is_server_side(client):
+    body = {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "c"}, "data": {"k": "v"}}
+    assert client.apply("/api/v1/namespaces/default/configmaps/c", body) == body
+    method, path, content_type, sent = StandInApi.requests[0]
+    assert method == "PATCH"
+    assert content_type == "application/apply-patch+yaml"
+    assert "fieldManager=thalamus" in path and "force=true" in path
+    assert sent == body
+
+def test_watch(client):
+    events = list(client.watch("/apis/apps/v1/namespaces/default/deployments", params={"resourceVersion": "1"}))
+    assert [(event_type, obj["metadata"]["name"]) for event_type, obj in events] == [("ADDED", "a"), ("MODIFIED", "b")]
+    assert "resourceVersion=1" in StandInApi.requests[0][1]
@@ -0,0 +1,24 @@
+import os
+import stat
+
+from thalamus.manifests import Manifest, install_config, license_secret, registry_secret, resource_path
+
+def test_saved_copy_leaves_out_secret_values(tmp_path):
+    manifest = Manifest([
+        license_secret("license-jwt"),
+        registry_secret("martindstone", "ghp_token"),
+        install_config("cortex.example.com", "api.cortex.example.com", "https"),
+    ])
+    path = str(tmp_path / ".thalamus" / "manifest.yaml")
+    manifest.write(path)
+    saved = open(path).read()
+    assert "license-jwt" not in saved and "ghp_token" not in saved
+    assert "ENTITLEMENTS_JWT: <redacted>" in saved and ".dockerconfigjson: <redacted>" in saved
+    assert "frontend: cortex.example.com" in saved
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    # what gets applied still has the values
+    assert manifest.objects[0]["stringData"] == {"ENTITLEMENTS_JWT": "license-jwt"}
+
+def test_resource_path():
+    assert resource_path(license_secret("x")) == "/api/v1/namespaces/default/secrets/cortex-secret"
+    assert resource_path(install_config("a", "b", "http")) == "/api/v1/namespaces/default/configmaps/thalamus-install"
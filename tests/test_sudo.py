@@ -0,0 +1,55 @@
+import threading
+import time
+
+import pytest
+
+from thalamus.sudo import Sudo
+
+def record(calls, name, delay=0, result=None):
+    def run():
+        time.sleep(delay)
+        calls.append(name)
+        return result
+    return run
+
+def test_graph_runs_steps_after_their_dependencies():
+    calls = []
+    steps = [
+        {"name": "c", "command": record(calls, "c"), "description": "C", "depends": ["a", "b"]},
+        {"name": "a", "command": record(calls, "a", 0.1, "A"), "description": "A"},
+        {"name": "b", "command": record(calls, "b", 0.05), "description": "B", "depends": []},
+    ]
+    assert Sudo(sudo=False).execute_step_graph(steps) == [None, "A", None]
+    assert calls == ["b", "a", "c"]
+
+def test_graph_runs_independent_steps_together():
+    started = threading.Barrier(3, timeout=5)
+    steps = [{"name": name, "command": started.wait, "description": name} for name in ("a", "b", "c")]
+    Sudo(sudo=False).execute_step_graph(steps)
+
+def test_graph_stops_at_the_first_failure():
+    calls = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    steps = [
+        {"name": "a", "command": fail, "description": "A"},
+        {"name": "b", "command": record(calls, "b", 0.2), "description": "B"},
+        {"name": "c", "command": record(calls, "c"), "description": "C", "depends": ["a"]},
+        {"name": "d", "command": record(calls, "d"), "description": "D", "depends": ["b"]},
+    ]
+    with pytest.raises(RuntimeError, match="boom"):
+        Sudo(sudo=False).execute_step_graph(steps)
+    # b may already be running and is left to finish, but nothing new starts
+    assert calls in ([], ["b"])
+
+@pytest.mark.parametrize("steps, message", [
+    ([{"name": "a", "command": "true", "description": "A", "depends": ["b"]},
+      {"name": "b", "command": "true", "description": "B", "depends": ["a"]}], "cycle"),
+    ([{"name": "a", "command": "true", "description": "A", "depends": ["x"]}], "unknown step x"),
+    ([{"name": "a", "command": "true", "description": "A"}, {"name": "a", "command": "true", "description": "A"}], "Duplicate"),
+])
+def test_graph_rejects_bad_dependencies(steps, message):
+    with pytest.raises(ValueError, match=message):
+        Sudo(sudo=False).execute_step_graph(steps)
@@ -0,0 +1,97 @@
+import os
+import shutil
+
+import pytest
+from ruamel.yaml import YAML
+
+from thalamus.values import Values, apply_overlay, diff_values, format_changes
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def values_path(tmp_path):
+    path = tmp_path / "values.yaml"
+    shutil.copy(os.path.join(REPO, "values.yaml"), path)
+    return str(path)
+
+def test_nested_keys_merge():
+    values = {"app": {"backend": {"replicaCount": 2, "image": {"repository": "r"}}}}
+    changes = []
+    apply_overlay(values, {"app": {"backend": {"replicaCount": 4}, "worker": {"replicaCount": 1}}}, changes)
+    assert values == {"app": {"backend": {"replicaCount": 4, "image": {"repository": "r"}}, "worker": {"replicaCount": 1}}}
+    assert changes == [("app.backend.replicaCount", 2, 4), ("app.worker", None, {"replicaCount": 1})]
+
+def test_lists_of_named_dicts_merge_by_name():
+    values = {"env": [{"name": "A", "value": "1"}, {"name": "B", "value": "2"}]}
+    changes = []
+    apply_overlay(values, {"env": [{"name": "B", "value": "3"}, {"name": "C", "value": "4"}]}, changes)
+    assert values["env"] == [{"name": "A", "value": "1"}, {"name": "B", "value": "3"}, {"name": "C", "value": "4"}]
+    assert changes == [("env[name=B].value", "2", "3"), ("env[name=C]", None, {"name": "C", "value": "4"})]
+
+def test_other_lists_are_replaced():
+    values = {"args": ["a", "b"], "hosts": [{"ip": "1.2.3.4"}]}
+    apply_overlay(values, {"args": ["c"], "hosts": [{"ip": "5.6.7.8"}]})
+    assert values == {"args": ["c"], "hosts": [{"ip": "5.6.7.8"}]}
+
+def test_scalar_and_empty_keys_are_replaced():
+    # `hostAliases:` and `envVars:` with nothing under them load as None
+    values = {"hostAliases": None, "envVars": None, "mode": "demo"}
+    changes = []
+    apply_overlay(values, {"hostAliases": [{"ip": "10.0.0.1", "hostnames": ["a"]}], "envVars": {"X": "1"}, "mode": {"name": "prod"}}, changes)
+    assert values == {"hostAliases": [{"ip": "10.0.0.1", "hostnames": ["a"]}], "envVars": {"X": "1"}, "mode": {"name": "prod"}}
+    assert [path for path, _, _ in changes] == ["hostAliases", "envVars", "mode"]
+
+def test_unchanged_values_record_nothing():
+    values = {"app": {"backend": {"replicaCount": 2}, "env": [{"name": "A", "value": "1"}]}}
+    changes = []
+    apply_overlay(values, {"app": {"backend": {"replicaCount": 2}, "env": [{"name": "A", "value": "1"}]}}, changes)
+    assert changes == []
+
+def test_overlay_is_copied():
+    overlay = {"app": {"hostAliases": [{"ip": "10.0.0.1"}]}}
+    values = apply_overlay({}, overlay)
+    values["app"]["hostAliases"].append({"ip": "10.0.0.2"})
+    assert overlay == {"app": {"hostAliases": [{"ip": "10.0.0.1"}]}}
+
+def test_diff_values():
+    old = {"app": {"backend": {"replicaCount": 2}, "mode": "demo"}}
+    new = {"app": {"backend": {"replicaCount": 3}, "mode": "demo", "worker": {"replicaCount": 1}}}
+    changes = diff_values(old, new)
+    assert changes == [("app.backend.replicaCount", 2, 3), ("app.worker", None, {"replicaCount": 1})]
+    assert format_changes(changes) == "app.backend.replicaCount: 2 -> 3\napp.worker: None -> {'replicaCount': 1}"
+    assert diff_values(new, new) == []
+
+def test_render_values_yaml(values_path):
+    values = Values()
+    rendered = values.render_values_yaml(
+        values_path,
+        {"app": {"backend": {"replicaCount": 3, "envVars": {"JAVA_TOOL_OPTIONS": "-Dx=1"}}}},
+        {"app": {"backend": {"hostAliases": [{"ip": "10.0.0.1", "hostnames": ["git.local"]}]}}},
+    )
+    backend = rendered["app"]["backend"]
+    assert backend["replicaCount"] == 3
+    assert backend["envVars"] == {"JAVA_TOOL_OPTIONS": "-Dx=1"}
+    assert backend["hostAliases"] == [{"ip": "10.0.0.1", "hostnames": ["git.local"]}]
+    assert backend["hikariMaxPoolSize"] == 20
+    assert sorted(path for path, _, _ in values.last_changes) == [
+        "app.backend.envVars", "app.backend.hostAliases", "app.backend.replicaCount"
+    ]
+
+def test_render_values_yaml_errors(values_path, tmp_path):
+    with pytest.raises(ValueError):
+        Values().render_values_yaml(values_path)
+    with pytest.raises(FileNotFoundError):
+        Values().render_values_yaml(str(tmp_path / "missing.yaml"), {"a": 1})
+
+def test_edit_values_yaml_keeps_a_backup(values_path):
+    with open(values_path, "rb") as f:
+        original = f.read()
+    backup_path = Values().edit_values_yaml(values_path, {"app": {"worker": {"replicaCount": 5}}})
+    with open(backup_path, "rb") as f:
+        assert f.read() == original
+    with open(values_path, "r") as f:
+        edited = f.read()
+    assert YAML(typ="safe").load(edited)["app"]["worker"]["replicaCount"] == 5
+    # comments survive the round trip
+    assert "# ================ Cortex API (Worker) Configuration" in edited
+    assert os.stat(values_path).st_mode == os.stat(backup_path).st_mode
@@ -0,0 +1,201 @@
+import asyncio
+import math
+import ssl
+
+class Connection:
+    def __init__(self, address, port, ssl_context=None, server_hostname=None):
+        self.address = address
+        self.port = port
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname
+        self.reader = None
+        self.writer = None
+
+    async def request(self, raw):
+        reused = self.writer is not None
+        if not reused:
+            await self.open()
+        try:
+            self.writer.write(raw)
+            await self.writer.drain()
+            response = await read_response(self.reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.close()
+            if not reused:
+                raise
+            # the server may have closed an idle keepalive connection; that's not a failed request
+            await self.open()
+            self.writer.write(raw)
+            await self.writer.drain()
+            response = await read_response(self.reader)
+        status, size, keep_alive = response
+        if not keep_alive:
+            self.close()
+        return status, size
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.address, self.port, ssl=self.ssl_context,
+            server_hostname=self.server_hostname if self.ssl_context else None
+        )
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed before a response")
+    status = int(status_line.split(None, 2)[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = headers.get("connection", "").lower() != "close"
+    size = 0
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            chunk_size = int((await reader.readline()).split(b";")[0], 16)
+            if chunk_size == 0:
+                # skip any trailers up to the blank line
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            await reader.readexactly(chunk_size + 2)
+            size += chunk_size
+    elif "content-length" in headers:
+        size = int(headers["content-length"])
+        await reader.readexactly(size)
+    elif status >= 200 and status not in (204, 304):
+        # no length, so the body runs until the server closes the connection
+        size = len(await reader.read())
+        keep_alive = False
+    return status, size, keep_alive
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+class HostStats:
+    def __init__(self, host, address, port, path):
+        self.host = host
+        self.address = address
+        self.port = port
+        self.path = path
+        self.latencies = []
+        self.statuses = {}
+        self.exceptions = {}
+        self.errors = 0
+        self.bytes = 0
+
+    def record(self, status, size, latency):
+        self.latencies.append(latency)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        self.bytes += size
+        if status >= 500:
+            self.errors += 1
+
+    def record_exception(self, e):
+        name = "Timeout" if isinstance(e, asyncio.TimeoutError) else type(e).__name__
+        self.exceptions[name] = self.exceptions.get(name, 0) + 1
+        self.errors += 1
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        requests = len(latencies) + sum(self.exceptions.values())
+
+        def ms(value):
+            return None if value is None else round(value * 1000, 2)
+
+        return {
+            "host": self.host,
+            "address": f"{self.address}:{self.port}",
+            "path": self.path,
+            "requests": requests,
+            "errors": self.errors,
+            "error_rate": round(self.errors / requests, 4) if requests else 0,
+            "throughput_rps": round((requests - self.errors) / elapsed, 2) if elapsed else 0,
+            "bytes": self.bytes,
+            "statuses": self.statuses,
+            "exceptions": self.exceptions,
+            "latency_ms": {
+                "p50": ms(percentile(latencies, 0.50)),
+                "p95": ms(percentile(latencies, 0.95)),
+                "p99": ms(percentile(latencies, 0.99)),
+                "max": ms(latencies[-1] if latencies else None),
+                "mean": ms(sum(latencies) / len(latencies) if latencies else None),
+            },
+        }
+
+async def load_host(target, rate, duration, connections, timeout, ssl_context):
+    host, address, port, path = target
+    stats = HostStats(host, address, port, path)
+    pool = asyncio.Queue()
+    for _ in range(connections):
+        pool.put_nowait(Connection(address, port, ssl_context, host))
+    raw = (
+        f"GET {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: thalamus-bench\r\n"
+        "Accept: */*\r\nAccept-Encoding: gzip\r\n\r\n"
+    ).encode("latin-1")
+
+    loop = asyncio.get_running_loop()
+
+    async def send(scheduled):
+        connection = await pool.get()
+        try:
+            status, size = await asyncio.wait_for(connection.request(raw), timeout)
+            # measured from when the request was due, so waiting for a free connection counts too
+            stats.record(status, size, loop.time() - scheduled)
+        except Exception as e:
+            connection.close()
+            stats.record_exception(e)
+        finally:
+            pool.put_nowait(connection)
+
+    # requests go out on a fixed schedule whether or not earlier ones have finished,
+    # so a slow server shows up as latency instead of quietly lowering the rate
+    start = loop.time()
+    tasks = []
+    for i in range(max(1, int(rate * duration))):
+        scheduled = start + i / rate
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(scheduled)))
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - start
+    while not pool.empty():
+        pool.get_nowait().close()
+    return stats.summary(elapsed)
+
+async def run_load(targets, rate, duration, connections, timeout, ssl_context):
+    return await asyncio.gather(*[
+        load_host(target, rate, duration, connections, timeout, ssl_context) for target in targets
+    ])
+
+def run_benchmark(targets, rate=50, duration=30, connections=16, timeout=10, tls=False, verify=True):
+    # targets are (host header, address, port, path); all hosts are loaded at the same time
+    ssl_context = None
+    if tls:
+        ssl_context = ssl.create_default_context()
+        if not verify:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+    return asyncio.run(run_load(targets, rate, duration, connections, timeout, ssl_context))
+
+def format_results(results):
+    lines = [f"{'host':<32} {'req/s':>8} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"]
+    for result in results:
+        latency = result["latency_ms"]
+        lines.append(
+            f"{result['host']:<32} {result['throughput_rps']:>8} {result['error_rate']:>7.2%} "
+            + " ".join(f"{'-' if latency[key] is None else latency[key]:>8}" for key in ("p50", "p95", "p99"))
+        )
+    return "\n".join(lines)
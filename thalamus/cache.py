@@ -0,0 +1,179 @@
+import fnmatch
+import hashlib
+import json
+import os
+import requests
+import tempfile
+import threading
+import time
+
+CHUNK_SIZE = 1024 * 1024
+
+class ChecksumMismatchError(Exception):
+    pass
+
+def read_chunks(f):
+    return iter(lambda: f.read(CHUNK_SIZE), b"")
+
+def install_file(chunks, dest, mode=0o755):
+    # write next to the destination and rename, so a running binary is never half-written
+    dest_dir = os.path.dirname(dest)
+    os.makedirs(dest_dir, exist_ok=True, mode=0o755)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix="." + os.path.basename(dest) + "-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in chunks:
+                out.write(chunk)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def make_dirs(path, owner=None):
+    # like os.makedirs, but every directory it creates is handed to owner (uid, gid),
+    # so running as root doesn't leave the user with a root-owned ~/.cache
+    missing = []
+    while not os.path.isdir(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+    for path in reversed(missing):
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            continue
+        if owner:
+            os.chown(path, *owner)
+
+class ArtifactCache:
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, offline=False, seed_dir=None, owner=None):
+        self.cache_dir = cache_dir
+        self.blobs_dir = os.path.join(cache_dir, "sha256")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.seed_dir = seed_dir
+        self.owner = owner
+        self.lock = threading.Lock()
+        make_dirs(self.blobs_dir, owner)
+        self.index = self.load_index()
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            index = {}
+        index.setdefault("artifacts", {})
+        index.setdefault("lookups", {})
+        return index
+
+    def save_index(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".index-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.index, f, indent=2)
+        self.give_to_owner(tmp_path)
+        os.replace(tmp_path, self.index_path)
+
+    def give_to_owner(self, path):
+        if self.owner:
+            os.chown(path, *self.owner)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_dir, digest)
+
+    def lookup(self, key, fetch, ttl=24 * 60 * 60):
+        # cache small lookups like "latest version" so we don't hit the network every run
+        with self.lock:
+            cached = self.index["lookups"].get(key)
+        if cached and (self.offline or time.time() - cached["time"] < ttl):
+            return cached["value"]
+        if self.offline:
+            raise FileNotFoundError(f"Offline mode: no cached value for {key}")
+        value = fetch()
+        with self.lock:
+            self.index["lookups"][key] = {"value": value, "time": time.time()}
+            self.save_index()
+        return value
+
+    def fetch(self, name, url=None, sha256=None, checksum_url=None, seed_patterns=()):
+        # returns the path of a verified local copy of the artifact called name
+        with self.lock:
+            entry = self.index["artifacts"].get(name)
+        if entry and os.path.exists(self.blob_path(entry["digest"])):
+            if self.offline or (entry["url"] == url and sha256 in (None, entry["digest"])):
+                os.utime(self.blob_path(entry["digest"]))
+                return self.blob_path(entry["digest"])
+
+        if self.offline:
+            seeded = self.find_seeded(seed_patterns)
+            if not seeded:
+                raise FileNotFoundError(f"Offline mode: {name} is not cached and was not found in the artifact directory")
+            with open(seeded, "rb") as f:
+                digest = self.store(read_chunks(f), sha256)
+            return self.record(name, seeded, digest)
+
+        if sha256 is None and checksum_url:
+            response = requests.get(checksum_url, timeout=30)
+            response.raise_for_status()
+            sha256 = response.text.split()[0].lower()
+        with requests.get(url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            digest = self.store(response.iter_content(CHUNK_SIZE), sha256)
+        return self.record(name, url, digest)
+
+    def find_seeded(self, patterns):
+        if not self.seed_dir or not os.path.isdir(self.seed_dir):
+            return None
+        for pattern in patterns:
+            matches = sorted(fnmatch.filter(os.listdir(self.seed_dir), pattern))
+            if matches:
+                return os.path.join(self.seed_dir, matches[-1])
+        return None
+
+    def store(self, chunks, sha256=None):
+        # stream into a temp file while hashing, then move it into place under its digest
+        hasher = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".download-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    out.write(chunk)
+            digest = hasher.hexdigest()
+            if sha256 and digest != sha256.lower():
+                raise ChecksumMismatchError(f"Checksum mismatch: expected {sha256}, got {digest}")
+            self.give_to_owner(tmp_path)
+            os.replace(tmp_path, self.blob_path(digest))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest
+
+    def record(self, name, url, digest):
+        with self.lock:
+            self.index["artifacts"][name] = {"url": url, "digest": digest}
+            self.evict(keep=digest)
+            self.save_index()
+        return self.blob_path(digest)
+
+    def evict(self, keep=None):
+        # drop least recently used blobs until the cache fits in max_bytes
+        blobs = []
+        for entry in os.scandir(self.blobs_dir):
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                blobs.append((stat.st_mtime, stat.st_size, entry.name))
+        total = sum(size for _, size, _ in blobs)
+        for _, size, digest in sorted(blobs):
+            if total <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            os.remove(self.blob_path(digest))
+            total -= size
+            self.index["artifacts"] = {
+                name: entry for name, entry in self.index["artifacts"].items() if entry["digest"] != digest
+            }
@@ -0,0 +1,81 @@
+import os
+import re
+import requests
+import shutil
+import tarfile
+from urllib.parse import urljoin
+from ruamel.yaml import YAML
+
+class ChartRepository:
+    def __init__(self, cache, url="https://helm-charts.cortex.io", chart="cortex"):
+        self.cache = cache
+        self.url = url.rstrip("/") + "/"
+        self.chart = chart
+
+    @staticmethod
+    def version_key(version):
+        return [int(part) for part in re.findall(r"\d+", version)]
+
+    def find_entry(self, version=None):
+        response = requests.get(urljoin(self.url, "index.yaml"), timeout=30)
+        response.raise_for_status()
+        entries = YAML(typ="safe").load(response.text).get("entries", {}).get(self.chart, [])
+        if version:
+            entries = [e for e in entries if e["version"] == version]
+        else:
+            # latest stable release; prereleases have to be pinned explicitly
+            entries = sorted(
+                (e for e in entries if "-" not in e["version"]), key=lambda e: self.version_key(e["version"])
+            )[-1:]
+        if not entries:
+            raise ValueError(f"Chart {self.chart} {version or 'release'} not found in {self.url}")
+        entry = entries[-1]
+        return {
+            "version": entry["version"],
+            "digest": entry.get("digest"),
+            "url": urljoin(self.url, entry["urls"][0]),
+        }
+
+    def resolve(self, version=None):
+        # pinned versions never change, so only "latest" needs to be looked up again
+        ttl = 24 * 60 * 60 if version is None else float("inf")
+        return self.cache.lookup(f"chart-{self.chart}-{version or 'latest'}", lambda: self.find_entry(version), ttl=ttl)
+
+    def fetch(self, version=None):
+        # returns the path of the cached chart tarball and its sha256 digest
+        try:
+            entry = self.resolve(version)
+        except FileNotFoundError:
+            if not self.cache.offline:
+                raise
+            entry = {"version": version, "digest": None, "url": None}
+        path = self.cache.fetch(
+            f"chart-{self.chart}-{entry['version'] or 'seeded'}",
+            url=entry["url"],
+            sha256=entry["digest"],
+            seed_patterns=[f"{self.chart}-{entry['version']}.tgz"] if entry["version"] else [f"{self.chart}-*.tgz"]
+        )
+        # cache blobs are named after their digest
+        return path, os.path.basename(path)
+
+    def extract(self, path, digest, dest_dir):
+        # streams the tarball into dest_dir/<chart>, unless that tree is already this chart
+        target = os.path.join(dest_dir, self.chart)
+        marker = os.path.join(target, ".thalamus-chart")
+        if os.path.exists(marker):
+            with open(marker, "r") as f:
+                if f.read().strip() == digest:
+                    return target
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        with tarfile.open(path, mode="r|gz") as contents:
+            for member in contents:
+                if member.name.startswith(self.chart + "/"):
+                    contents.extract(member, dest_dir, filter="data")
+        with open(marker, "w") as f:
+            f.write(digest + "\n")
+        return target
+
+    def install(self, dest_dir, version=None):
+        path, digest = self.fetch(version)
+        return self.extract(path, digest, dest_dir)
@@ -0,0 +1,145 @@
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from ruamel.yaml import YAML
+
+class SSHHost:
+    def __init__(self, host, user=None, port=22, key=None, sudo=None, options=(), control_dir=None):
+        self.host = host
+        self.user = user
+        self.port = port
+        self.key = key
+        # non-root users need sudo on the other end
+        self.sudo = sudo if sudo is not None else user not in (None, "root")
+        self.options = list(options)
+        self.control_dir = control_dir or tempfile.gettempdir()
+
+    def __str__(self):
+        return f"{self.user}@{self.host}" if self.user else self.host
+
+    def ssh_args(self):
+        # one multiplexed master connection per host; every later command reuses it
+        args = [
+            "ssh",
+            "-o", "BatchMode=yes",
+            "-o", "StrictHostKeyChecking=accept-new",
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPath={os.path.join(self.control_dir, '%C')}",
+            "-o", "ControlPersist=120",
+            "-p", str(self.port),
+        ]
+        if self.key:
+            args += ["-i", self.key]
+        for option in self.options:
+            args += ["-o", option]
+        return args + [str(self)]
+
+    def run(self, command, input=None, timeout=None):
+        remote = f"sudo -n sh -c {shlex.quote(command)}" if self.sudo else command
+        result = subprocess.run(self.ssh_args() + ["--", remote], input=input, capture_output=True, timeout=timeout)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(
+                result.returncode, f"ssh {self} {command}", output=result.stdout + result.stderr
+            )
+        return result.stdout
+
+    def close(self):
+        subprocess.run(self.ssh_args()[:-1] + ["-O", "exit", str(self)], capture_output=True)
+
+class Fleet:
+    def __init__(self, controllers, workers, max_workers=16):
+        # controllers and workers join the cluster whose first controller is this machine
+        self.controllers = controllers
+        self.workers = workers
+        self.max_workers = max_workers
+        self.control_dir = tempfile.mkdtemp(prefix="thalamus-ssh-")
+        for host in self.hosts:
+            host.control_dir = self.control_dir
+
+    @classmethod
+    def from_inventory(cls, path, home_dir=None):
+        with open(path, "r") as f:
+            inventory = YAML(typ="safe").load(f) or {}
+        defaults = {key: inventory[key] for key in ("user", "port", "key", "sudo", "options") if key in inventory}
+
+        def make_host(entry):
+            if isinstance(entry, str):
+                entry = {"host": entry}
+            host = dict(defaults, **entry)
+            # we run under sudo, so ~ has to mean the invoking user's home, not root's
+            if home_dir and (host.get("key") or "").startswith("~/"):
+                host["key"] = os.path.join(home_dir, host["key"][2:])
+            return SSHHost(**host)
+
+        return cls(
+            [make_host(entry) for entry in inventory.get("controllers", [])],
+            [make_host(entry) for entry in inventory.get("workers", [])],
+            max_workers=inventory.get("parallelism", 16)
+        )
+
+    @property
+    def hosts(self):
+        return self.controllers + self.workers
+
+    @property
+    def node_count(self):
+        return 1 + len(self.hosts)
+
+    def run_parallel(self, hosts, fn):
+        # run fn(host) for all hosts at once; the first failure is raised once the others have finished
+        if not hosts:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(hosts))) as executor:
+            futures = {executor.submit(fn, host): host for host in hosts}
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in not_done:
+                future.cancel()
+            for future in futures:
+                if future.done() and not future.cancelled() and future.exception() is not None:
+                    raise Exception(f"{futures[future]}: {future.exception()}")
+            return [future.result() for future in futures]
+
+    def install_k0s(self):
+        self.run_parallel(self.hosts, lambda host: host.run("curl -sSLf https://get.k0s.sh | sh"))
+
+    @staticmethod
+    def create_token(role):
+        return subprocess.check_output(
+            ["k0s", "token", "create", f"--role={role}", "--expiry=1h"], stderr=subprocess.STDOUT
+        ).strip()
+
+    def join(self, files=None, config_path=None, worker_profile=None):
+        # files ({path: content}) are written on every host before k0s is installed, so the
+        # joined nodes get the same k0s and containerd config as this one.
+        # tokens go over stdin into a root-only file, so they never show up in a command line
+        tokens = {}
+        if self.controllers:
+            tokens["controller"] = self.create_token("controller")
+        if self.workers:
+            tokens["worker"] = self.create_token("worker")
+
+        def join_host(host):
+            role = "worker" if host in self.workers else "controller"
+            for path, content in (files or {}).items():
+                host.run(
+                    f"mkdir -p {shlex.quote(os.path.dirname(path))} && cat > {shlex.quote(path)}",
+                    input=content.encode("utf-8")
+                )
+            host.run("umask 077 && mkdir -p /etc/k0s && cat > /etc/k0s/join.token", input=tokens[role])
+            install = "k0s install worker" if role == "worker" else "k0s install controller --enable-worker --no-taints"
+            # controllers must share the cluster config; the kubelet profile comes from it
+            if config_path and role == "controller":
+                install += f" --config {config_path}"
+            if worker_profile:
+                install += f" --profile {worker_profile}"
+            host.run(f"{install} --token-file /etc/k0s/join.token && k0s start")
+
+        self.run_parallel(self.hosts, join_host)
+
+    def close(self):
+        for host in self.hosts:
+            host.close()
+        shutil.rmtree(self.control_dir, ignore_errors=True)
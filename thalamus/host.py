@@ -0,0 +1,69 @@
+import os
+
+GIB = 1024 * 1024 * 1024
+
+def read_file(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+class HostProfile:
+    # below this the JVMs don't start reliably
+    minimum_cpus = 4
+    minimum_memory = 12 * GIB
+
+    def __init__(self, cpus, memory):
+        self.cpus = cpus
+        self.memory = memory
+
+    @classmethod
+    def detect(cls):
+        return cls(cls.detect_cpus(), cls.detect_memory())
+
+    @staticmethod
+    def detect_cpus():
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        # cgroup v2, then v1
+        quota = None
+        cpu_max = read_file("/sys/fs/cgroup/cpu.max")
+        if cpu_max and not cpu_max.startswith("max"):
+            limit, period = cpu_max.split()
+            quota = int(limit) / int(period)
+        else:
+            limit = read_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+            period = read_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+            if limit and period and int(limit) > 0:
+                quota = int(limit) / int(period)
+        if quota:
+            cpus = min(cpus, max(1, int(quota)))
+        return cpus
+
+    @staticmethod
+    def detect_memory():
+        memory = None
+        meminfo = read_file("/proc/meminfo") or ""
+        for line in meminfo.splitlines():
+            if line.startswith("MemTotal:"):
+                memory = int(line.split()[1]) * 1024
+        if memory is None:
+            memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        # cgroup v2, then v1 (v1 reports "unlimited" as a huge number)
+        limit = read_file("/sys/fs/cgroup/memory.max") or read_file("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+        if limit and limit.isdigit():
+            memory = min(memory, int(limit))
+        return memory
+
+    def warnings(self):
+        warnings = []
+        if self.cpus < self.minimum_cpus:
+            warnings.append(f"This host has {self.cpus} CPUs; Cortex needs at least {self.minimum_cpus}.")
+        if self.memory < self.minimum_memory:
+            warnings.append(
+                f"This host has {self.memory / GIB:.1f} GiB of memory; Cortex needs at least {self.minimum_memory // GIB} GiB."
+            )
+        return warnings
+
+    def __repr__(self):
+        return f"HostProfile(cpus={self.cpus}, memory={self.memory / GIB:.1f}GiB)"
@@ -0,0 +1,84 @@
+import os
+import subprocess
+import termios
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from ruamel.yaml import YAML
+
+from thalamus.wait import wait_for
+
+def chart_images(values):
+    # every enabled component under app with an image.repository; the tag is the
+    # component's own image.version if it has one, otherwise the chart-wide image.version
+    version = values.get("image", {}).get("version")
+    images = []
+    for component in values.get("app", {}).values():
+        if not isinstance(component, Mapping) or component.get("enabled") is False:
+            continue
+        image = component.get("image")
+        if not isinstance(image, Mapping) or not image.get("repository"):
+            continue
+        reference = f"{image['repository']}:{image.get('version', version)}"
+        if reference not in images:
+            images.append(reference)
+    return images
+
+def read_chart_images(values_path):
+    with open(values_path, "r") as f:
+        return chart_images(YAML(typ="safe").load(f) or {})
+
+class ImagePuller:
+    # talks to the containerd inside k0s, in the namespace the kubelet uses
+    def __init__(self, namespace="k8s.io", max_workers=4):
+        self.ctr = ["k0s", "ctr", "--namespace", namespace]
+        self.max_workers = max_workers
+
+    def wait_for_containerd(self, timeout=120):
+        wait_for(
+            lambda: subprocess.run(self.ctr + ["version"], capture_output=True).returncode == 0,
+            timeout, description="containerd"
+        )
+
+    def list_images(self):
+        output = subprocess.check_output(self.ctr + ["images", "list", "--quiet"], stderr=subprocess.STDOUT)
+        return set(output.decode("utf-8").split())
+
+    def import_bundle(self, path):
+        subprocess.check_output(self.ctr + ["images", "import", path], stderr=subprocess.STDOUT)
+
+    def pull(self, reference, user=None):
+        # user is "name:password". ctr only reads a password from a terminal, so it gets a pty
+        # with the password already typed in; on the command line, ps and any error would show it
+        if not user:
+            subprocess.check_output(self.ctr + ["images", "pull", reference], stderr=subprocess.STDOUT)
+            return
+        name, _, password = user.partition(":")
+        master_fd, terminal_fd = os.openpty()
+        try:
+            attrs = termios.tcgetattr(terminal_fd)
+            attrs[3] &= ~termios.ECHO
+            termios.tcsetattr(terminal_fd, termios.TCSANOW, attrs)
+            os.write(master_fd, password.encode("utf-8") + b"\n")
+            subprocess.run(
+                self.ctr + ["images", "pull", "--user", name, reference],
+                stdin=terminal_fd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True
+            )
+        finally:
+            os.close(master_fd)
+            os.close(terminal_fd)
+
+    def prepull(self, references, user=None, bundle=None, offline=False):
+        self.wait_for_containerd()
+        if bundle:
+            self.import_bundle(bundle)
+        present = self.list_images()
+        missing = [reference for reference in references if reference not in present]
+        if offline:
+            if missing:
+                raise Exception("Images not found in the image bundle: " + ", ".join(missing))
+            return []
+        # containerd already fetches the layers of one image in parallel; this overlaps the images too
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as executor:
+                list(executor.map(lambda reference: self.pull(reference, user), missing))
+        return missing
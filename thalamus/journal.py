@@ -0,0 +1,50 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+class StepJournal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self.steps = json.load(f).get("steps", {})
+        except (FileNotFoundError, ValueError):
+            self.steps = {}
+
+    @staticmethod
+    def is_journaled(step):
+        return "name" in step and step.get("journal", True)
+
+    @staticmethod
+    def fingerprint(step, upstream=()):
+        # string commands are their own inputs; lambda steps list theirs under "inputs".
+        # upstream fingerprints are included so a changed step also re-runs everything after it.
+        inputs = step["command"] if isinstance(step["command"], str) else step.get("inputs")
+        data = json.dumps([step["name"], inputs, list(upstream)], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def is_complete(self, name, fingerprint):
+        with self.lock:
+            entry = self.steps.get(name)
+        return entry is not None and entry["fingerprint"] == fingerprint
+
+    def mark_complete(self, name, fingerprint):
+        with self.lock:
+            self.steps[name] = {"fingerprint": fingerprint, "completed_at": time.time()}
+            self.save()
+
+    def clear(self):
+        with self.lock:
+            self.steps = {}
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".journal-")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"steps": self.steps}, f, indent=2)
+        os.replace(tmp_path, self.path)
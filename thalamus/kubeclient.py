@@ -0,0 +1,114 @@
+import base64
+import json
+import os
+import requests
+import shutil
+import tempfile
+from requests.adapters import HTTPAdapter
+from ruamel.yaml import YAML
+
+class KubeApiError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(f"Kubernetes API error {status_code}: {message}")
+        self.status_code = status_code
+        self.message = message
+
+class KubeClient:
+    def __init__(self, kube_config_path, field_manager="thalamus"):
+        # read the kubeconfig once and keep one pooled connection to the API server
+        yaml = YAML(typ="safe")
+        with open(kube_config_path, "r") as f:
+            config = yaml.load(f)
+        context = self.find_named(config.get("contexts", []), config.get("current-context"), "context")
+        cluster = self.find_named(config.get("clusters", []), context.get("cluster"), "cluster")
+        user = self.find_named(config.get("users", []), context.get("user"), "user") if context.get("user") else {}
+
+        self.server = cluster["server"].rstrip("/")
+        self.namespace = context.get("namespace", "default")
+        self.field_manager = field_manager
+        self.temp_dir = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        if cluster.get("certificate-authority-data"):
+            self.session.verify = self.write_temp("ca.crt", cluster["certificate-authority-data"])
+        elif cluster.get("certificate-authority"):
+            self.session.verify = cluster["certificate-authority"]
+        elif cluster.get("insecure-skip-tls-verify"):
+            self.session.verify = False
+
+        if user.get("client-certificate-data") and user.get("client-key-data"):
+            self.session.cert = (
+                self.write_temp("client.crt", user["client-certificate-data"]),
+                self.write_temp("client.key", user["client-key-data"])
+            )
+        elif user.get("client-certificate") and user.get("client-key"):
+            self.session.cert = (user["client-certificate"], user["client-key"])
+        if user.get("token"):
+            self.session.headers["Authorization"] = f"Bearer {user['token']}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def find_named(items, name, kind):
+        for item in items:
+            if item.get("name") == name:
+                return item.get(kind, {})
+        if len(items) == 1 and name is None:
+            return items[0].get(kind, {})
+        raise KeyError(f"{kind} {name} not found in kubeconfig")
+
+    def write_temp(self, name, data):
+        # requests needs certificates and keys as files; keep them private and remove them on close
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.mkdtemp(prefix="thalamus-kube-")
+        path = os.path.join(self.temp_dir, name)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(base64.b64decode(data))
+        return path
+
+    def close(self):
+        self.session.close()
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", 30)
+        response = self.session.request(method, self.server + path, **kwargs)
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("message", response.text)
+            except ValueError:
+                message = response.text
+            raise KubeApiError(response.status_code, message)
+        return response
+
+    def get(self, path, params=None):
+        return self.request("GET", path, params=params).json()
+
+    def apply(self, path, body, force=True):
+        # server-side apply; JSON is valid YAML so the body can be sent as-is
+        return self.request(
+            "PATCH",
+            path,
+            data=json.dumps(body),
+            headers={"Content-Type": "application/apply-patch+yaml"},
+            params={"fieldManager": self.field_manager, "force": "true" if force else "false"}
+        ).json()
+
+    def watch(self, path, params=None, timeout=300):
+        # yields (event type, object) until the server ends the watch after timeout seconds
+        params = dict(params or {}, watch="true", timeoutSeconds=int(timeout))
+        with self.request("GET", path, params=params, stream=True, timeout=(10, timeout + 10)) as response:
+            for line in response.iter_lines():
+                if line:
+                    event = json.loads(line)
+                    yield event["type"], event["object"]
@@ -1,5 +1,5 @@
+import base64
 import json
-import io
 import os
 import platform
 import requests
@@ -7,9 +7,15 @@ import shutil
 import subprocess
 import tarfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from thalamus.cache import ArtifactCache, install_file, read_chunks
+from thalamus.kubeclient import KubeApiError, KubeClient
+from thalamus.manifests import resource_path
+from thalamus.wait import wait_for, wait_for_file
 
 class Kubernetes:
-    def __init__(self, sudo):
+    def __init__(self, sudo, cache=None):
         self.os_type = platform.system().lower()
         arch = platform.machine()
         if arch in ["x86_64", "AMD64"]:
@@ -20,50 +26,89 @@ class Kubernetes:
         self.sudo = sudo
         self.kube_home = os.path.join(self.sudo.get_home_dir(), ".kube")
         self.kube_config_path = os.path.join(self.kube_home, "config")
+        if cache is None:
+            cache = ArtifactCache(
+                os.path.join(self.sudo.get_home_dir(), ".cache", "thalamus"),
+                owner=(self.sudo.get_original_uid(), self.sudo.get_original_gid())
+            )
+        self.cache = cache
+        self.client = None
+
+    registry_user = "martindstone"
 
     install_k0s_steps = [
         {
+            "name": "download-k0s",
             "command": "curl -sSLf https://get.k0s.sh/ -o k0s-install.sh",
             "description": "Download k0s"
         },
         {
+            "name": "chmod-k0s-install",
             "command": "chmod +x k0s-install.sh",
-            "description": "Make k0s-install.sh executable"
+            "description": "Make k0s-install.sh executable",
+            "depends": ["download-k0s"]
         },
         {
+            "name": "run-k0s-install",
             "command": "./k0s-install.sh",
-            "description": "Run k0s-install.sh"
+            "description": "Run k0s-install.sh",
+            "depends": ["chmod-k0s-install"]
         },
         {
+            "name": "install-k0s",
             "command": "k0s install controller --single",
-            "description": "Install k0s"
+            "description": "Install k0s",
+            "depends": ["run-k0s-install"]
         },
         {
+            "name": "start-k0s",
             "command": "k0s start",
-            "description": "Start k0s"
+            "description": "Start k0s",
+            "depends": ["install-k0s"]
         }
     ]
 
+    def get_install_k0s_steps(self, single=True, config_path=None, worker_profile=None, depends=()):
+        steps = [dict(step) for step in self.install_k0s_steps]
+        for step in steps:
+            if step["name"] != "install-k0s":
+                continue
+            if not single:
+                # a --single controller can't accept joins, so other nodes need a controller that also runs workloads
+                step["command"] = "k0s install controller --enable-worker --no-taints"
+            if config_path:
+                step["command"] += f" --config {config_path}"
+            if worker_profile:
+                step["command"] += f" --profile {worker_profile}"
+            step["depends"] = step["depends"] + list(depends)
+        return steps
+
+    def get_kubectl_version(self):
+        response = requests.get("https://dl.k8s.io/release/stable.txt", timeout=30)
+        response.raise_for_status()
+        return response.text.strip()
+
     def install_kubectl(self):
-        response = requests.get("https://dl.k8s.io/release/stable.txt")
-        version = response.text.strip()
-        url = f"https://dl.k8s.io/release/{version}/bin/{self.os_type}/{self.arch}/kubectl"
-        response = requests.get(url)
-        os.makedirs("/usr/local/bin", exist_ok=True, mode=0o755)
-        with open("/usr/local/bin/kubectl", "wb") as f:
-            f.write(response.content)
-        os.chmod("/usr/local/bin/kubectl", 0o755)
+        url = None
+        if not self.cache.offline:
+            version = self.cache.lookup("kubectl-version", self.get_kubectl_version)
+            url = f"https://dl.k8s.io/release/{version}/bin/{self.os_type}/{self.arch}/kubectl"
+        path = self.cache.fetch(
+            f"kubectl-{self.os_type}-{self.arch}",
+            url=url,
+            checksum_url=url and url + ".sha256",
+            seed_patterns=[f"kubectl-*-{self.os_type}-{self.arch}", "kubectl"]
+        )
+        with open(path, "rb") as f:
+            install_file(read_chunks(f), "/usr/local/bin/kubectl")
 
     def configure_kubectl(self):
         admin_conf_path = "/var/lib/k0s/pki/admin.conf"
 
-        # sometimes the admin.conf file is not immediately available
-        tries = 0
-        while not os.path.exists(admin_conf_path) and tries < 5:
-            time.sleep(2)
-            if not os.path.exists(admin_conf_path):
-                raise FileNotFoundError("k0s admin.conf not found")
-        if not os.path.exists(admin_conf_path):
+        # the admin.conf file shows up a little while after k0s starts
+        try:
+            wait_for_file(admin_conf_path, timeout=120, description="k0s admin.conf")
+        except TimeoutError:
             raise FileNotFoundError("k0s admin.conf not found")
 
         os.makedirs(self.kube_home, exist_ok=True)
@@ -71,56 +116,197 @@ class Kubernetes:
         self.sudo.chown_to_original(self.kube_home)
         os.chmod(self.kube_config_path, 0o600)
 
+    def get_client(self):
+        if self.client is None:
+            self.client = KubeClient(self.kube_config_path)
+        return self.client
+
+    def close(self):
+        # the client keeps the decoded admin key in a temp dir until it's closed
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def check_kubectl_config(self):
-        cmd = f"kubectl --kubeconfig={self.kube_config_path} get nodes"
         try:
-            subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise Exception("kubectl config is not valid: " + e.output.decode("utf-8"))
+            self.get_client().get("/api/v1/nodes")
+        except (KubeApiError, requests.RequestException) as e:
+            raise Exception("kubectl config is not valid: " + str(e))
+        return True
+
+    def wait_for_kubectl(self, timeout=150):
+        wait_for(self.check_kubectl_config, timeout, ignore=(Exception,), description="the Kubernetes API")
+
+    def get_helm_version(self):
+        response = requests.get("https://api.github.com/repos/helm/helm/releases/latest", timeout=30)
+        response.raise_for_status()
+        return response.json()["tag_name"]
 
     def install_helm(self):
-        # get latest helm release
-        response = requests.get("https://api.github.com/repos/helm/helm/releases/latest")
-        version = response.json()["tag_name"]
-        
-        # download and open the helm tarball
-        url = f"https://get.helm.sh/helm-{version}-{self.os_type}-{self.arch}.tar.gz"
-        response = requests.get(url)
-        file_like_object = io.BytesIO(response.content)
-        contents = tarfile.open(fileobj=file_like_object, mode="r:gz")
-
-        # find the helm binary in the tarball
-        members = [m for m in contents.getmembers() if os.path.basename(m.name) == "helm"]
-        if not members:
-            raise FileNotFoundError("helm binary not found in tarball")
-        extracted = contents.extractfile(members[0])
-        os.makedirs("/usr/local/bin", exist_ok=True, mode=0o755)
-        
-        # write helm binary to /usr/local/bin
-        with open("/usr/local/bin/helm", "wb") as f:
-            f.write(extracted.read())
-        os.chmod("/usr/local/bin/helm", 0o755)
-
-    # def add_secrets(self, github_token, license):
-    #     self.sudo.execute_steps([
-    #         {
-    #             "command": f"kubectl --kubeconfig {self.kube_config_path} create secret generic cortex-secret --from-literal ENTITLEMENTS_JWT='{license}'",
-    #             "description": "Add Cortex license"
-    #         },
-    #         {
-    #             "command": f"kubectl --kubeconfig {self.kube_config_path} create secret docker-registry cortex-docker-registry-secret --docker-server=ghcr.io --docker-username=martindstone --docker-password={github_token} --docker-email=martindstone@me.com",
-    #             "description": "Add GitHub token"
-    #         }
-    #     ])
-
-    def check_all_deployments_ready(self):
-        cmd = f"kubectl --kubeconfig={self.kube_config_path} get deployments -o json"
-        output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).decode("utf-8")
-        ds = json.loads(output)
-        for deployment in ds["items"]:
-            if deployment.get("status", {}).get("readyReplicas", 0) != deployment.get("status", {}).get("replicas", -1):
+        url = None
+        if not self.cache.offline:
+            version = self.cache.lookup("helm-version", self.get_helm_version)
+            url = f"https://get.helm.sh/helm-{version}-{self.os_type}-{self.arch}.tar.gz"
+        path = self.cache.fetch(
+            f"helm-{self.os_type}-{self.arch}",
+            url=url,
+            checksum_url=url and url + ".sha256sum",
+            seed_patterns=[f"helm-*-{self.os_type}-{self.arch}.tar.gz"]
+        )
+
+        # find the helm binary in the tarball and stream it to /usr/local/bin
+        with tarfile.open(path, mode="r:gz") as contents:
+            members = [m for m in contents.getmembers() if os.path.basename(m.name) == "helm"]
+            if not members:
+                raise FileNotFoundError("helm binary not found in tarball")
+            install_file(read_chunks(contents.extractfile(members[0])), "/usr/local/bin/helm")
+
+    def secret_is_current(self, secret):
+        try:
+            existing = self.get_client().get(resource_path(secret))
+        except KubeApiError as e:
+            if e.status_code == 404:
                 return False
-        return True
+            raise
+        data = {key: base64.b64decode(value).decode("utf-8") for key, value in existing.get("data", {}).items()}
+        return existing.get("type") == secret["type"] and data == secret["stringData"]
+
+    def apply_manifest(self, manifest, save_path=None, max_workers=8):
+        # the API has no batch endpoint, so every object is its own server-side apply;
+        # they go out together over the pooled connections, and re-applying is a no-op
+        if save_path:
+            manifest.write(save_path)
+        client = self.get_client()
+        if not manifest.objects:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(manifest.objects))) as executor:
+            return list(executor.map(lambda obj: client.apply(resource_path(obj), obj), manifest.objects))
+
+    def spread_replicas(self, namespace="default"):
+        # the chart has no setting for it, so each replicated deployment gets a spread constraint
+        # on its own selector; ScheduleAnyway still places pods if a node is short on room
+        client = self.get_client()
+        path = f"/apis/apps/v1/namespaces/{namespace}/deployments"
+        spread = []
+        for deployment in client.get(path)["items"]:
+            if deployment["spec"].get("replicas", 1) < 2:
+                continue
+            name = deployment["metadata"]["name"]
+            client.apply(f"{path}/{name}", {
+                "apiVersion": "apps/v1",
+                "kind": "Deployment",
+                "metadata": {"name": name, "namespace": namespace},
+                "spec": {"template": {"spec": {"topologySpreadConstraints": [{
+                    "maxSkew": 1,
+                    "topologyKey": "kubernetes.io/hostname",
+                    "whenUnsatisfiable": "ScheduleAnyway",
+                    "labelSelector": {"matchLabels": deployment["spec"]["selector"]["matchLabels"]},
+                }]}}},
+            })
+            spread.append(name)
+        return spread
+
+    def helm_command(self, *args):
+        return ["helm", "--kubeconfig", self.kube_config_path] + list(args)
+
+    def release_exists(self, release="cortex"):
+        if not os.path.exists(self.kube_config_path) or shutil.which("helm") is None:
+            return False
+        result = subprocess.run(self.helm_command("status", release), capture_output=True)
+        return result.returncode == 0
+
+    def get_release_values(self, release="cortex"):
+        # --all includes the chart defaults, so this compares like for like with a full values.yaml
+        output = subprocess.check_output(
+            self.helm_command("get", "values", release, "--all", "-o", "json"), stderr=subprocess.STDOUT
+        )
+        return json.loads(output) or {}
+
+    def list_service_ips(self):
+        services = self.get_client().get("/api/v1/namespaces/default/services")["items"]
+        return {service["metadata"]["name"]: service["spec"].get("clusterIP") for service in services}
+
+    def get_service_ips(self, names):
+        # one list call, however many services we need
+        ips = self.list_service_ips()
+        missing = [name for name in names if name not in ips]
+        if missing:
+            raise Exception("Services not found: " + ", ".join(missing))
+        return [ips[name] for name in names]
+
+    def wait_for_services(self, names, timeout=120):
+        wait_for(
+            lambda: set(names) <= set(self.list_service_ips()),
+            timeout, description="services " + ", ".join(names)
+        )
+
+    def count_ready_nodes(self):
+        nodes = self.get_client().get("/api/v1/nodes")["items"]
+        return sum(
+            1 for node in nodes
+            if any(c["type"] == "Ready" and c["status"] == "True" for c in node.get("status", {}).get("conditions", []))
+        )
+
+    def wait_for_nodes_ready(self, count, timeout=600):
+        # nodes join independently, so one listing covers all of them at once
+        wait_for(lambda: self.count_ready_nodes() >= count, timeout, description=f"{count} ready nodes")
+
+    def is_deployment_ready(self, deployment):
+        # like `kubectl rollout status`: the controller has seen the latest spec and
+        # every replica is from it, so a rolling update in progress isn't ready yet
+        status = deployment.get("status", {})
+        if status.get("observedGeneration", 0) < deployment.get("metadata", {}).get("generation", 0):
+            return False
+        replicas = deployment.get("spec", {}).get("replicas", 1)
+        return status.get("updatedReplicas", 0) == replicas and status.get("readyReplicas", 0) == status.get("replicas", 0)
+
+    def wait_for_deployments_ready(self, timeout=30 * 60, on_pending=None):
+        path = "/apis/apps/v1/namespaces/default/deployments"
+        deadline = time.monotonic() + timeout
+        ready = {}
+        pending = None
+        resource_version = None
+
+        def update_pending():
+            nonlocal pending
+            still_pending = sorted(name for name, is_ready in ready.items() if not is_ready)
+            if still_pending != pending and on_pending:
+                on_pending(still_pending)
+            pending = still_pending
+            return bool(ready) and not pending
+
+        while True:
+            if resource_version is None:
+                # (re)list to get the current state and a resourceVersion to watch from
+                ds = self.get_client().get(path)
+                ready = {d["metadata"]["name"]: self.is_deployment_ready(d) for d in ds["items"]}
+                resource_version = ds["metadata"]["resourceVersion"]
+            if update_pending():
+                return
 
-    def install_k0s(self):
-        self.sudo.execute_steps(self.install_k0s_steps)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Deployments not ready in time: " + ", ".join(pending))
+            try:
+                for event_type, deployment in self.get_client().watch(
+                    path, params={"resourceVersion": resource_version}, timeout=min(remaining, 300)
+                ):
+                    if event_type == "ERROR":
+                        # usually 410 Gone: our resourceVersion is too old, so list again
+                        resource_version = None
+                        break
+                    resource_version = deployment["metadata"]["resourceVersion"]
+                    if event_type == "DELETED":
+                        ready.pop(deployment["metadata"]["name"], None)
+                    else:
+                        ready[deployment["metadata"]["name"]] = self.is_deployment_ready(deployment)
+                    if update_pending():
+                        return
+            except requests.RequestException:
+                resource_version = None
@@ -1,47 +1,37 @@
 #!/usr/bin/env python3
 
 import click
-import jwt
+import copy
 import os
 import re
-import requests
-import socket
-import sys
-import time
 
 from thalamus.sudo import Sudo
-from thalamus.kubernetes import Kubernetes
-from thalamus.values import Values
-from thalamus.nginx import make_nginx_config
-from thalamus.utils import runcmd
-
-click.clear()
-sudo = Sudo()
-
-click.echo(click.style("--- WARNING ---", fg="red", bold=True))
-click.echo("This script is meant to run on a fresh Linux machine. It will install software and delete files.")
-click.echo("Don't run this on a machine that you care about!")
-user_accepts_the_risk = click.prompt(click.style("To continue, type 'I do not care about this machine'", fg="red"), type=str)
-if user_accepts_the_risk != "I do not care about this machine":
-    click.echo("You might care about this machine. Exiting.")
-    sys.exit(1)
-
-click.echo("Getting external IP address... ", nl=False)
-try:
-    external_ip = requests.get("https://api.ipify.org").text
-    if not external_ip:
-        raise Exception("Failed to get external IP address")
-except:
-    click.echo(click.style("Error: ", fg="red", bold=True) + "Failed to get external IP address. Do you have an internet connection?")
-    click.get_current_context().exit(1)
-click.echo(click.style(external_ip, fg="green"))
+from thalamus.host import GIB, HostProfile
+from thalamus.nginx import make_nginx_config, reload_nginx, tune_nginx_main_config
+from thalamus.preflight import Preflight
+from thalamus.trace import Tracer
+from thalamus.journal import StepJournal
 
-def validate_hostname(ctx, param, value):
-    if not ctx.obj:
-        ctx.obj = {}
-    if not ctx.obj.get(param.name):
-        ctx.obj[param.name] = {}
+# when we re-run ourselves under sudo, the checks that already passed come along in the environment
+PREFLIGHT_ENV = "THALAMUS_PREFLIGHT"
+preflight = Preflight(os.environ.get(PREFLIGHT_ENV))
 
+def acknowledge_risk(ctx, param, value):
+    # this option is eager, so it runs before the other options prompt for anything
+    preflight.start_external_ip()
+    if value:
+        return value
+    click.clear()
+    click.echo(click.style("--- WARNING ---", fg="red", bold=True))
+    click.echo("This script is meant to run on a fresh Linux machine. It will install software and delete files.")
+    click.echo("Don't run this on a machine that you care about!")
+    user_accepts_the_risk = click.prompt(click.style("To continue, type 'I do not care about this machine'", fg="red"), type=str)
+    if user_accepts_the_risk != "I do not care about this machine":
+        click.echo("You might care about this machine. Exiting.")
+        ctx.exit(1)
+    return True
+
+def validate_hostname(ctx, param, value):
     if not value:
         raise click.BadParameter(f"{param.name} cannot be empty")
 
@@ -59,172 +49,381 @@ def validate_hostname(ctx, param, value):
     if len(value) > 253:
         raise click.BadParameter(f"Invalid hostname for {param.name}")
 
-    try:
-        lookup = socket.gethostbyname(value)
-    except:
-        lookup = None
-    
-    if not lookup:
-        ctx.obj['no_lookup'] = True
-        if not ctx.obj[param.name].get('confirmed_dns_warning', False):  # Check if we've already confirmed
-            if click.confirm(f"Hostname {value} doesn't resolve to an IP. You'll need to add it to DNS or /etc/hosts later. Continue?", default=False):
-                ctx.obj[param.name]['confirmed_dns_warning'] = True
-                return value
-            else:
+    # the lookup itself is checked in check_hostnames, once all the prompts are answered
+    preflight.start_resolve(value)
+    return value
+
+def check_hostnames(ctx, external_ip, *hostnames):
+    if not ctx.obj:
+        ctx.obj = {}
+    for value in hostnames:
+        try:
+            lookup = preflight.resolve_hostname(value)
+        except Exception:
+            lookup = None
+
+        if (not lookup or lookup != external_ip) and preflight.is_remembered(("confirmed", value)):
+            ctx.obj['no_lookup'] = True
+        elif not lookup:
+            ctx.obj['no_lookup'] = True
+            if not click.confirm(f"Hostname {value} doesn't resolve to an IP. You'll need to add it to DNS or /etc/hosts later. Continue?", default=False):
                 raise click.Abort()
+            preflight.remember(("confirmed", value), True)
 
-    # If lookup succeeds but doesn't match external IP, ask for confirmation to continue
-    if lookup and lookup != external_ip:
-        ctx.obj['no_lookup'] = True
-        if not ctx.obj[param.name].get('confirmed_ip_mismatch', False):  # Check if we've already confirmed
-            if click.confirm(f"Hostname {value} resolves to {lookup}, not {external_ip}. You'll need to update DNS or /etc/hosts later. Continue?", default=False):
-                ctx.obj[param.name]['confirmed_ip_mismatch'] = True  # Set flag to skip future confirmation
-                return value
-            else:
+        # If lookup succeeds but doesn't match external IP, ask for confirmation to continue
+        elif lookup != external_ip:
+            ctx.obj['no_lookup'] = True
+            if not click.confirm(f"Hostname {value} resolves to {lookup}, not {external_ip}. You'll need to update DNS or /etc/hosts later. Continue?", default=False):
                 raise click.Abort()
-    return value
+            preflight.remember(("confirmed", value), True)
+
+def validate_optional_hostname(ctx, param, value):
+    return value if value is None else validate_hostname(ctx, param, value)
 
 def validate_github_pat(ctx, param, value):
-    url = "https://api.github.com/orgs/cortexapps/packages/docker/cortex-onprem-backend"
-    headers = {
-        "Accept": "application/vnd.github+json",
-        "Authorization": f"Bearer {value}",
-        "X-GitHub-Api-Version": "2022-11-28"
-    }
+    if value is None:
+        return value
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200 or response.json().get("package_type") != "container":
-            raise click.BadParameter("Invalid GitHub PAT")
-    except:
+        preflight.github_pat_is_valid(value)
+    except Exception:
         raise click.BadParameter("Invalid GitHub PAT")
     return value
 
 def validate_license(ctx, param, value):
+    if value is None:
+        return value
     try:
-        headers = jwt.get_unverified_header(value)
-        if headers.get("typ") != "JWT":
-            raise click.BadParameter("Invalid license key")
-        payload = jwt.decode(value, options={"verify_signature": False})
-        if not payload.get("entitlements"):
-            raise click.BadParameter("Invalid license key")
-    except:
+        preflight.license_payload(value)
+    except Exception:
         raise click.BadParameter("Invalid license key")
     return value
 
-@click.command()
+def hostname_values(frontend, backend, tls_cert):
+    return {
+        "app": {
+            "hostnames": {
+                "backend": backend,
+                "frontend": frontend,
+                "protocol": "https" if tls_cert else "http",
+            }
+        }
+    }
+
+def profile_values_template(values, profile, host):
+    if profile != "auto":
+        return values.get_values_template(profile)
+    click.echo(f"Sizing Cortex for {host.cpus} CPUs and {host.memory / GIB:.1f} GiB of memory")
+    for warning in host.warnings():
+        click.echo(click.style("Warning: ", fg="yellow", bold=True) + warning)
+    return values.auto_values_template(host)
+
+class DefaultGroup(click.Group):
+    # plain `install-cortex [options]` keeps installing; other commands are named explicitly
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.commands and args[0] != "--help"):
+            args = ["install"] + list(args)
+        return super().parse_args(ctx, args)
+
+@click.group(cls=DefaultGroup)
+def main():
+    pass
+
+@main.command(help="Install k0s, Cortex and nginx on this machine (the default command)")
+@click.option("--accept-risk", is_flag=True, is_eager=True, envvar="CORTEX_ACCEPT_RISK", callback=acknowledge_risk, help="Skip the warning about running on a machine you care about")
 @click.option("--frontend", help="Hostname for the web UI", prompt="Frontend hostname", envvar="CORTEX_FRONTEND_HOSTNAME", callback=validate_hostname)
 @click.option("--backend", help="Hostname for the backend API", prompt="Backend hostname", envvar="CORTEX_BACKEND_HOSTNAME", callback=validate_hostname)
 @click.option("--cortex-license", help="Cortex license", prompt="Cortex license", envvar="ENTITLEMENTS_JWT", callback=validate_license)
 @click.option("--github-pat", help="GitHub Personal Access Token", prompt="GitHub PAT", envvar="CORTEX_GITHUB_PAT", callback=validate_github_pat)
+@click.option("--offline", is_flag=True, envvar="CORTEX_OFFLINE", help="Install kubectl and Helm from the local cache or --artifact-dir, and images from --image-bundle, without downloading")
+@click.option("--artifact-dir", help="Directory of pre-downloaded kubectl and Helm artifacts", envvar="CORTEX_ARTIFACT_DIR", type=click.Path(exists=True, file_okay=False))
+@click.option("--image-bundle", help="OCI image tarball to import into the cluster before pulling anything", envvar="CORTEX_IMAGE_BUNDLE", type=click.Path(exists=True, dir_okay=False, resolve_path=True))
+@click.option("--cache-size", help="Maximum size of the artifact cache in MB", envvar="CORTEX_CACHE_SIZE", type=int, default=1024, show_default=True)
+@click.option("--profile", type=click.Choice(["demo", "auto"]), default="demo", show_default=True, envvar="CORTEX_PROFILE", help="Values profile; 'auto' sizes replicas, JVM heaps and resources to this host")
+@click.option("--tune/--no-tune", default=True, help="Tune kernel limits, containerd and the kubelet for this host before k0s starts")
+@click.option("--inventory", help="YAML inventory of extra controller and worker hosts to join over SSH", envvar="CORTEX_INVENTORY", type=click.Path(exists=True, dir_okay=False, resolve_path=True))
+@click.option("--tls-cert", help="TLS certificate for nginx; enables HTTPS and HTTP/2", envvar="CORTEX_TLS_CERT", type=click.Path(exists=True, dir_okay=False, resolve_path=True))
+@click.option("--tls-key", help="TLS private key for --tls-cert", envvar="CORTEX_TLS_KEY", type=click.Path(exists=True, dir_okay=False, resolve_path=True))
+@click.option("--chart-version", help="Cortex Helm chart version to install (default: latest)", envvar="CORTEX_CHART_VERSION")
+@click.option("--trace", help="Write step timings as JSON and Chrome trace events to this file", type=click.Path(dir_okay=False, writable=True))
+@click.option("--resume/--force", default=True, help="Skip steps completed by a previous run, or run every step again")
+@click.option("--verbose", is_flag=True, help="Show the output of each step as it runs")
 @click.option("--dry-run", is_flag=True)
 @click.pass_context
-def main(ctx, frontend, backend, cortex_license, github_pat, dry_run):
+def install(ctx, accept_risk, frontend, backend, cortex_license, github_pat, offline, artifact_dir, image_bundle, cache_size, profile, tune, inventory, tls_cert, tls_key, chart_version, trace, resume, verbose, dry_run):
     if frontend == backend:
         click.echo(click.style("Error: ", fg="red", bold=True) + "Frontend and backend hostnames cannot be the same")
         click.get_current_context().exit(1)
 
+    if bool(tls_cert) != bool(tls_key):
+        click.echo(click.style("Error: ", fg="red", bold=True) + "--tls-cert and --tls-key must be used together")
+        click.get_current_context().exit(1)
+
+    tracer = Tracer()
+    click.echo("Getting external IP address... ", nl=False)
+    try:
+        with tracer.span("Get external IP address", "preflight"):
+            external_ip = preflight.external_ip()
+    except Exception:
+        click.echo(click.style("Error: ", fg="red", bold=True) + "Failed to get external IP address. Do you have an internet connection?")
+        click.get_current_context().exit(1)
+    click.echo(click.style(external_ip, fg="green"))
+    with tracer.span("Check hostnames", "preflight"):
+        check_hostnames(ctx, external_ip, frontend, backend)
+
     if dry_run:
         click.echo(click.style("Dry run: ", fg="yellow", bold=True) + "No changes will be made")
         click.get_current_context().exit(0)
 
-    hostname_values_update = {
-        "app": {
-            "hostnames": {
-                "backend": backend,
-                "frontend": frontend,
-            }
-        }
-    }
+    # real work starts here, so this is where we need root
+    sudo = Sudo(tracer=tracer, env={
+        "CORTEX_ACCEPT_RISK": "1",
+        "CORTEX_FRONTEND_HOSTNAME": frontend,
+        "CORTEX_BACKEND_HOSTNAME": backend,
+        "ENTITLEMENTS_JWT": cortex_license,
+        "CORTEX_GITHUB_PAT": github_pat,
+        PREFLIGHT_ENV: preflight.export(),
+        **({"CORTEX_INVENTORY": inventory} if inventory else {}),
+        # lets root use the invoking user's SSH agent for the fleet hosts
+        **({"SSH_AUTH_SOCK": os.environ["SSH_AUTH_SOCK"]} if inventory and "SSH_AUTH_SOCK" in os.environ else {}),
+    })
+
+    # these pull in requests and ruamel.yaml, so they're only imported once we get this far
+    from thalamus.kubernetes import Kubernetes
+    from thalamus.cache import ArtifactCache
+    from thalamus.charts import ChartRepository
+    from thalamus.values import Values, apply_overlay
+    from thalamus.state import install_state_path, save_install_state
+    from thalamus.images import ImagePuller, read_chart_images
+    from thalamus.tuning import Tuning
+    from thalamus.manifests import Manifest, install_config, license_secret, registry_secret
 
+    cache = ArtifactCache(
+        os.path.join(sudo.get_home_dir(), ".cache", "thalamus"),
+        max_bytes=cache_size * 1024 * 1024,
+        offline=offline,
+        seed_dir=artifact_dir,
+        owner=(sudo.get_original_uid(), sudo.get_original_gid())
+    )
+    kubernetes = Kubernetes(sudo, cache)
+    # however the command ends, remove the client's decoded admin key
+    ctx.call_on_close(kubernetes.close)
+    # a finished install is reconfigured in place rather than bootstrapped again
+    if resume and kubernetes.release_exists() and os.path.exists(install_state_path(sudo.get_home_dir())):
+        click.echo(click.style("Cortex is already installed; upgrading it instead", fg="green", bold=True))
+        # the default profile would undo an auto or fleet sizing, so only one the user asked for is reapplied
+        if ctx.get_parameter_source("profile") in (None, click.core.ParameterSource.DEFAULT):
+            profile = None
+        ctx.invoke(
+            upgrade, frontend=frontend, backend=backend, cortex_license=cortex_license, github_pat=github_pat,
+            profile=profile, tls_cert=tls_cert, tls_key=tls_key, chart_version=chart_version,
+            offline=offline, artifact_dir=artifact_dir, verbose=verbose
+        )
+        return
+
+    hostname_values_update = hostname_values(frontend, backend, tls_cert)
     values = Values()
-    kubernetes = Kubernetes(sudo)
+    host = HostProfile.detect()
+    values_template = profile_values_template(values, profile, host)
+    tuning = Tuning(host)
+    tuning_steps = []
+    if tune:
+        tuning_steps = [
+            {
+                "name": "tune-host",
+                "command": lambda: tuning.tune_host(),
+                "inputs": [tuning.render_sysctl(), tuning.render_nginx_limits()],
+                "description": "Tune kernel and nginx limits"
+            },
+            {
+                "name": "configure-k0s",
+                "command": lambda: tuning.write_k0s_config(),
+                "inputs": [tuning.render_k0s_config(), tuning.render_containerd_config()],
+                "description": "Write k0s and containerd config"
+            }
+        ]
+    fleet = None
+    fleet_steps = []
+    if inventory:
+        from thalamus.fleet import Fleet
+        fleet = Fleet.from_inventory(inventory, sudo.get_home_dir())
+        click.echo(f"Joining {len(fleet.controllers)} controllers and {len(fleet.workers)} workers to this node")
+        # one backend and one worker replica per node at least, so the load spreads across the cluster
+        values_template = copy.deepcopy(values_template)
+        for component in ("backend", "worker"):
+            settings = values_template["app"][component]
+            settings["replicaCount"] = max(settings["replicaCount"], fleet.node_count)
+        # tuned nodes get the same k0s config, worker profile and containerd drop-in as this one
+        join_settings = {}
+        if tune:
+            join_settings = {
+                "files": {
+                    tuning.k0s_config_path: tuning.render_k0s_config(),
+                    tuning.containerd_config_path: tuning.render_containerd_config(),
+                },
+                "config_path": tuning.k0s_config_path,
+                "worker_profile": tuning.worker_profile,
+            }
+        fleet_steps = [
+            {
+                "name": "fleet-install-k0s",
+                "command": lambda: fleet.install_k0s(),
+                "inputs": [str(host) for host in fleet.hosts],
+                "description": "Install k0s on fleet hosts"
+            },
+            {
+                "name": "fleet-join",
+                "command": lambda: fleet.join(**join_settings),
+                "inputs": [[str(host) for host in fleet.controllers], [str(host) for host in fleet.workers], join_settings],
+                "description": "Join fleet hosts to the cluster",
+                "depends": ["wait-for-kubectl", "fleet-install-k0s"]
+            },
+            {
+                "name": "wait-for-nodes",
+                "command": lambda: kubernetes.wait_for_nodes_ready(fleet.node_count),
+                "description": "Wait for all nodes to be ready",
+                "depends": ["fleet-join"],
+                "journal": False
+            },
+            {
+                "name": "spread-replicas",
+                "command": lambda: kubernetes.spread_replicas(),
+                "inputs": [fleet.node_count],
+                "description": "Spread Cortex replicas across nodes",
+                "depends": ["install-cortex"]
+            }
+        ]
+    chart_repository = ChartRepository(cache)
+    chart_path = os.path.join(sudo.get_home_dir(), chart_repository.chart)
+    # every cluster object the installer owns, applied together
+    install_manifest = Manifest([
+        license_secret(cortex_license),
+        registry_secret(kubernetes.registry_user, github_pat),
+        install_config(frontend, backend, "https" if tls_cert else "http"),
+    ])
+    manifest_path = os.path.join(sudo.get_home_dir(), ".thalamus", "manifest.yaml")
+    journal_path = os.path.join(sudo.get_home_dir(), ".thalamus", "journal.json")
+    sudo.journal = StepJournal(journal_path)
+    if not resume:
+        sudo.journal.clear()
+    sudo.log_dir = os.path.join(os.path.dirname(journal_path), "logs")
+    sudo.live_output = verbose
+
+    def pull_images():
+        try:
+            ImagePuller().prepull(
+                read_chart_images(os.path.join(chart_path, "values.yaml")),
+                user=f"{kubernetes.registry_user}:{github_pat}", bundle=image_bundle, offline=offline
+            )
+        except Exception as e:
+            # offline, nothing else can fetch a missing image; online the kubelet pulls whatever we didn't
+            if offline:
+                raise
+            click.echo(click.style("Warning: ", fg="yellow", bold=True) + f"Couldn't pull the images ahead of time, Kubernetes will pull them instead: {sudo.describe_error(e)}")
 
     click.echo(click.style("Starting installation...", fg="green", bold=True))
     try:
-        kubernetes.install_k0s()
-        sudo.execute_steps([
+        k0s_steps = kubernetes.get_install_k0s_steps(single=fleet is None)
+        if tune:
+            k0s_steps = kubernetes.get_install_k0s_steps(
+                single=fleet is None, config_path=tuning.k0s_config_path, worker_profile=tuning.worker_profile,
+                depends=["configure-k0s"]
+            )
+        sudo.execute_step_graph(tuning_steps + k0s_steps + fleet_steps + [
             {
+                "name": "install-kubectl",
                 "command": lambda: kubernetes.install_kubectl(),
                 "description": "Install kubectl"
             },
             {
+                "name": "configure-kubectl",
                 "command": lambda: kubernetes.configure_kubectl(),
-                "description": "Configure kubectl"
-            }
-        ])
-        click.echo("Wait for kubectl to be ready... ", nl=False)
-        time.sleep(5)
-        kubectl_ready = False
-        tries = 0
-        while not kubectl_ready and tries < 5:
-            try:
-                kubernetes.check_kubectl_config()
-                kubectl_ready = True
-            except Exception as e:
-                click.echo(".", nl=False)
-                tries += 1
-                time.sleep(5)
-        if not kubectl_ready:
-            raise Exception("kubectl never became ready")
-        click.echo(click.style("done", fg="green"))
-        sudo.execute_steps([
+                "description": "Configure kubectl",
+                "depends": ["start-k0s"]
+            },
             {
-                "command": f"kubectl --kubeconfig {kubernetes.kube_config_path} create secret generic cortex-secret --from-literal ENTITLEMENTS_JWT='{cortex_license}'",
-                "description": "Add Cortex license"
+                "name": "wait-for-kubectl",
+                "command": lambda: kubernetes.wait_for_kubectl(),
+                "description": "Wait for Kubernetes API to be ready",
+                "depends": ["configure-kubectl"],
+                "journal": False
             },
             {
-                "command": f"kubectl --kubeconfig {kubernetes.kube_config_path} create secret docker-registry cortex-docker-registry-secret --docker-server=ghcr.io --docker-username=martindstone --docker-password={github_pat} --docker-email=martindstone@me.com",
-                "description": "Add GitHub token"
+                "name": "apply-manifest",
+                "command": lambda: kubernetes.apply_manifest(install_manifest, save_path=manifest_path),
+                "inputs": install_manifest.objects,
+                "description": "Apply Cortex license, GitHub token and config",
+                "depends": ["wait-for-kubectl"]
             },
             {
+                "name": "install-helm",
                 "command": lambda: kubernetes.install_helm(),
                 "description": "Install Helm"
             },
             {
-                "command": f"helm --kubeconfig {kubernetes.kube_config_path} repo add cortex https://helm-charts.cortex.io",
-                "description": "Add Cortex Helm repository"
+                "name": "fetch-chart",
+                "command": lambda: sudo.chown_to_original(chart_repository.install(sudo.get_home_dir(), chart_version)),
+                "inputs": chart_version,
+                "description": "Download and extract Cortex Helm chart"
             },
             {
-                "command": f"helm --kubeconfig {kubernetes.kube_config_path} pull cortex/cortex",
-                "description": "Download Cortex Helm chart"
+                "name": "edit-values",
+                "command": lambda: values.edit_values_yaml(
+                    os.path.join(chart_path, "values.yaml"), values_template, hostname_values_update
+                ),
+                "inputs": [values_template, hostname_values_update],
+                "description": "Edit values.yaml",
+                "depends": ["fetch-chart"]
             },
             {
-                "command": "tar -xvf cortex-*.tgz",
-                "description": "Extract Cortex Helm chart"
+                # pulls start as soon as containerd is up and the chart says which images to get,
+                # while the secrets, Helm and nginx steps carry on
+                "name": "pull-images",
+                "command": pull_images,
+                "inputs": [chart_version, image_bundle],
+                "description": "Pull Cortex images",
+                "depends": ["start-k0s", "edit-values"]
             },
             {
-                "command": lambda: values.edit_values_yaml(
-                    os.path.join(sudo.home_dir, "cortex", "values.yaml"), values.get_values_template("demo"), hostname_values_update
-                ),
-                "description": "Edit values.yaml"
+                "name": "install-nginx",
+                "command": "apt install -y nginx",
+                "description": "Install nginx"
             },
             {
-                "command": f"helm --kubeconfig {kubernetes.kube_config_path} install cortex ./cortex",
-                "description": "Install Cortex"
+                "name": "tune-nginx",
+                "command": lambda: tune_nginx_main_config("/etc/nginx/nginx.conf", host),
+                "inputs": [host.cpus, host.memory],
+                "description": "Tune nginx workers",
+                "depends": ["install-nginx"]
             },
             {
-                "command": lambda: time.sleep(5),
-                "description": "Wait for services to be created"
+                # upgrade --install also takes over a release a failed attempt left behind, so a retry converges
+                "name": "install-cortex",
+                "command": f"helm --kubeconfig {kubernetes.kube_config_path} upgrade --install cortex {chart_path}",
+                "description": "Install Cortex",
+                "depends": ["apply-manifest", "install-helm", "edit-values", "pull-images"] + (["wait-for-nodes"] if fleet else [])
+            },
+            {
+                "name": "wait-for-services",
+                "command": lambda: kubernetes.wait_for_services(["cortex-frontend-service", "cortex-backend-service"]),
+                "description": "Wait for services to be created",
+                "depends": ["install-cortex"],
+                "journal": False
             }
         ])
-        click.echo("Get frontend IP address... ", nl=False)
-        frontend_ip = runcmd(f"kubectl --kubeconfig {kubernetes.kube_config_path} get svc cortex-frontend-service -o jsonpath='{{.spec.clusterIP}}'")
-        click.echo(click.style(frontend_ip, fg="green"))
-        click.echo("Get backend IP address... ", nl=False)
-        backend_ip = runcmd(f"kubectl --kubeconfig {kubernetes.kube_config_path} get svc cortex-backend-service -o jsonpath='{{.spec.clusterIP}}'")
-        click.echo(click.style(backend_ip, fg="green"))
+        click.echo("Get frontend and backend IP addresses... ", nl=False)
+        with tracer.span("Get frontend and backend IP addresses", "wait"):
+            frontend_ip, backend_ip = kubernetes.get_service_ips(["cortex-frontend-service", "cortex-backend-service"])
+        click.echo(click.style(f"{frontend_ip}, {backend_ip}", fg="green"))
         sudo.execute_steps([
             {
-                "command": "apt install -y nginx",
-                "description": "Install nginx"
-            },
-            {
-                "command": lambda: make_nginx_config("/etc/nginx/sites-available/default", frontend, frontend_ip, backend, backend_ip),
+                "command": lambda: make_nginx_config(
+                    "/etc/nginx/sites-available/default", frontend, frontend_ip, backend, backend_ip, tls_cert, tls_key
+                ),
                 "description": "Create nginx config"
             },
             {
-                "command": "systemctl restart nginx",
-                "description": "Restart nginx"
+                "command": lambda: reload_nginx(),
+                "description": "Reload nginx"
             }
         ])
         click.echo(click.style("Installation complete! ", fg="green", bold=True))
@@ -234,11 +433,300 @@ def main(ctx, frontend, backend, cortex_license, github_pat, dry_run):
                     f"Don't forget to set up name lookup for hosts {frontend} and {backend} to {external_ip} in your DNS server or /etc/hosts file.", bold=True
                 )
             )
-        click.echo("Waiting for services to be available (this could take a few minutes)...", nl=False)
-        while not kubernetes.check_all_deployments_ready():
-            time.sleep(5)
-            click.echo(".", nl=False)
-        click.echo(click.style(" done", fg="green"))
+        click.echo("Waiting for services to be available (this could take a few minutes)...")
+        with tracer.span("Wait for services to be available", "wait"):
+            kubernetes.wait_for_deployments_ready(
+                on_pending=lambda pending: pending and click.echo("  Waiting for: " + ", ".join(pending))
+            )
+        click.echo(click.style("done", fg="green"))
+        # only a finished install is recorded, so a rerun after a failure resumes instead of upgrading
+        save_install_state({
+            "frontend": frontend,
+            "backend": backend,
+            "frontend_ip": frontend_ip,
+            "backend_ip": backend_ip,
+            "external_ip": external_ip,
+            "protocol": "https" if tls_cert else "http",
+            "tls_cert": tls_cert,
+            "tls_key": tls_key,
+            "profile": profile,
+            # everything edit-values changed, so an upgrade can reapply it to a fresh chart
+            "values": apply_overlay(apply_overlay({}, values_template), hostname_values_update),
+        }, sudo.get_home_dir())
         click.echo(click.style("🎉 Cortex is ready! 🎉", bold=True))
     except Exception as e:
         click.echo(click.style("Installation halted: ", fg="red", bold=True) + str(e))
+        click.echo(f"Step logs are in {sudo.log_dir}")
+        click.echo("Run install-cortex again to resume from the failed step, or with --force to start over.")
+    finally:
+        if fleet:
+            fleet.close()
+        if os.path.exists(journal_path):
+            sudo.chown_to_original(os.path.dirname(journal_path))
+        if trace:
+            tracer.write(trace)
+            sudo.chown_to_original(trace)
+            click.echo(f"Install trace written to {trace}")
+
+@main.command(help="Reconfigure or upgrade an installed Cortex in place with helm upgrade")
+@click.option("--frontend", help="New hostname for the web UI", envvar="CORTEX_FRONTEND_HOSTNAME", callback=validate_optional_hostname)
+@click.option("--backend", help="New hostname for the backend API", envvar="CORTEX_BACKEND_HOSTNAME", callback=validate_optional_hostname)
+@click.option("--cortex-license", help="New Cortex license", envvar="ENTITLEMENTS_JWT", callback=validate_license)
+@click.option("--github-pat", help="New GitHub Personal Access Token", envvar="CORTEX_GITHUB_PAT", callback=validate_github_pat)
+@click.option("--profile", type=click.Choice(["demo", "auto"]), envvar="CORTEX_PROFILE", help="Reapply a values profile on top of the installed values")
+@click.option("--backend-replicas", type=click.IntRange(min=1), help="Number of backend replicas")
+@click.option("--worker-replicas", type=click.IntRange(min=1), help="Number of worker replicas")
+@click.option("--values", "values_file", help="YAML file of extra values to merge in last", type=click.Path(exists=True, dir_okay=False, resolve_path=True))
+@click.option("--tls-cert", help="TLS certificate for nginx; enables HTTPS and HTTP/2", envvar="CORTEX_TLS_CERT", type=click.Path(exists=True, dir_okay=False, resolve_path=True))
+@click.option("--tls-key", help="TLS private key for --tls-cert", envvar="CORTEX_TLS_KEY", type=click.Path(exists=True, dir_okay=False, resolve_path=True))
+@click.option("--chart-version", help="Cortex Helm chart version to upgrade to (default: keep the installed chart)", envvar="CORTEX_CHART_VERSION")
+@click.option("--offline", is_flag=True, envvar="CORTEX_OFFLINE", help="Fetch the chart from the local cache or --artifact-dir without downloading")
+@click.option("--artifact-dir", help="Directory of pre-downloaded artifacts", envvar="CORTEX_ARTIFACT_DIR", type=click.Path(exists=True, file_okay=False))
+@click.option("--timeout", default="15m", show_default=True, help="How long helm waits for the rolling update")
+@click.option("--verbose", is_flag=True, help="Show the output of each step as it runs")
+@click.option("--dry-run", is_flag=True, help="Show what would change without changing it")
+def upgrade(frontend, backend, cortex_license, github_pat, profile, backend_replicas, worker_replicas, values_file, tls_cert, tls_key, chart_version, offline, artifact_dir, timeout, verbose, dry_run):
+    from thalamus.state import load_install_state
+
+    try:
+        state = load_install_state()
+    except FileNotFoundError:
+        state = {}
+    frontend = frontend or state.get("frontend")
+    backend = backend or state.get("backend")
+    tls_cert = tls_cert or state.get("tls_cert")
+    tls_key = tls_key or state.get("tls_key")
+    if not frontend or not backend:
+        click.echo(click.style("Error: ", fg="red", bold=True) + "No saved install state, so --frontend and --backend are required")
+        click.get_current_context().exit(1)
+    if frontend == backend:
+        click.echo(click.style("Error: ", fg="red", bold=True) + "Frontend and backend hostnames cannot be the same")
+        click.get_current_context().exit(1)
+    if bool(tls_cert) != bool(tls_key):
+        click.echo(click.style("Error: ", fg="red", bold=True) + "--tls-cert and --tls-key must be used together")
+        click.get_current_context().exit(1)
+
+    sudo = Sudo(env={
+        key: value for key, value in (("ENTITLEMENTS_JWT", cortex_license), ("CORTEX_GITHUB_PAT", github_pat)) if value
+    })
+    sudo.log_dir = os.path.join(sudo.get_home_dir(), ".thalamus", "logs")
+    sudo.live_output = verbose
+
+    from thalamus.kubernetes import Kubernetes
+    from thalamus.cache import ArtifactCache
+    from thalamus.charts import ChartRepository
+    from thalamus.values import Values, apply_overlay, diff_values, format_changes
+    from thalamus.state import save_install_state
+    from thalamus.manifests import Manifest, install_config, license_secret, registry_secret
+
+    cache = ArtifactCache(
+        os.path.join(sudo.get_home_dir(), ".cache", "thalamus"),
+        offline=offline,
+        seed_dir=artifact_dir,
+        owner=(sudo.get_original_uid(), sudo.get_original_gid())
+    )
+    kubernetes = Kubernetes(sudo, cache)
+    click.get_current_context().call_on_close(kubernetes.close)
+    if not kubernetes.release_exists():
+        click.echo(click.style("Error: ", fg="red", bold=True) + "No Cortex release found. Run install-cortex to install it.")
+        click.get_current_context().exit(1)
+
+    chart_repository = ChartRepository(cache)
+    chart_path = os.path.join(sudo.get_home_dir(), chart_repository.chart)
+    try:
+        if chart_version or not os.path.exists(chart_path):
+            sudo.execute_steps([{
+                "command": lambda: sudo.chown_to_original(chart_repository.install(sudo.get_home_dir(), chart_version)),
+                "description": "Download and extract Cortex Helm chart"
+            }])
+
+        # start from what the install (or the last upgrade) applied, so a freshly extracted chart gets it too
+        overlay = apply_overlay({}, state.get("values", {}))
+        values = Values()
+        if profile:
+            apply_overlay(overlay, profile_values_template(values, profile, HostProfile.detect()))
+        apply_overlay(overlay, hostname_values(frontend, backend, tls_cert))
+        replicas = {
+            component: {"replicaCount": count}
+            for component, count in (("backend", backend_replicas), ("worker", worker_replicas)) if count
+        }
+        if replicas:
+            apply_overlay(overlay, {"app": replicas})
+        if values_file:
+            from ruamel.yaml import YAML
+            with open(values_file, "r") as f:
+                apply_overlay(overlay, YAML(typ="safe").load(f) or {})
+
+        values_path = os.path.join(chart_path, "values.yaml")
+        changes = diff_values(kubernetes.get_release_values(), values.render_values_yaml(values_path, overlay))
+        secrets = [license_secret(cortex_license)] if cortex_license else []
+        secrets += [registry_secret(kubernetes.registry_user, github_pat)] if github_pat else []
+        changed_secrets = [secret for secret in secrets if not kubernetes.secret_is_current(secret)]
+        nginx_changed = [frontend, backend, tls_cert, tls_key] != [state.get(key) for key in ("frontend", "backend", "tls_cert", "tls_key")]
+    except Exception as e:
+        click.echo(click.style("Upgrade halted: ", fg="red", bold=True) + str(e))
+        click.get_current_context().exit(1)
+
+    if not changes and not changed_secrets and not nginx_changed:
+        click.echo(click.style("Cortex is already up to date", fg="green", bold=True))
+        return
+    if changes:
+        click.echo("Values changes:\n" + format_changes(changes))
+    for secret in changed_secrets:
+        click.echo(f"Secret {secret['metadata']['name']} changed")
+    if nginx_changed:
+        click.echo("nginx config changed")
+    if dry_run:
+        click.echo(click.style("Dry run: ", fg="yellow", bold=True) + "No changes will be made")
+        return
+
+    service_names = ["cortex-frontend-service", "cortex-backend-service"]
+    manifest = Manifest(changed_secrets)
+    if nginx_changed:
+        manifest.add(install_config(frontend, backend, "https" if tls_cert else "http"))
+    steps = []
+    if manifest.objects:
+        steps.append({
+            "command": lambda: kubernetes.apply_manifest(
+                manifest, save_path=os.path.join(sudo.get_home_dir(), ".thalamus", "manifest.yaml")
+            ),
+            "description": "Apply changed secrets and config"
+        })
+    if changes:
+        steps += [
+            {
+                "command": lambda: values.edit_values_yaml(values_path, overlay),
+                "description": "Edit values.yaml"
+            },
+            {
+                # --atomic rolls the release back if the new pods don't become ready in time
+                "command": f"helm --kubeconfig {kubernetes.kube_config_path} upgrade cortex {chart_path} --wait --atomic --timeout {timeout}",
+                "description": "Upgrade Cortex"
+            }
+        ]
+    if any(secret["metadata"]["name"] == "cortex-secret" for secret in changed_secrets):
+        # pods only read the license at startup, so roll them to pick up the new one
+        steps += [
+            {
+                "command": f"kubectl --kubeconfig {kubernetes.kube_config_path} rollout restart deployment --namespace default",
+                "description": "Restart Cortex to load the new license"
+            },
+            {
+                "command": lambda: kubernetes.wait_for_deployments_ready(),
+                "description": "Wait for the restarted pods"
+            }
+        ]
+    def update_nginx_config():
+        frontend_ip, backend_ip = kubernetes.get_service_ips(service_names)
+        make_nginx_config("/etc/nginx/sites-available/default", frontend, frontend_ip, backend, backend_ip, tls_cert, tls_key)
+
+    if nginx_changed:
+        steps += [
+            {
+                "command": update_nginx_config,
+                "description": "Update nginx config"
+            },
+            {
+                "command": lambda: reload_nginx(),
+                "description": "Reload nginx"
+            }
+        ]
+    try:
+        sudo.execute_steps(steps)
+        frontend_ip, backend_ip = kubernetes.get_service_ips(service_names)
+        save_install_state(dict(
+            state, frontend=frontend, backend=backend, tls_cert=tls_cert, tls_key=tls_key,
+            protocol="https" if tls_cert else "http", values=overlay, frontend_ip=frontend_ip, backend_ip=backend_ip
+        ), sudo.get_home_dir())
+        sudo.chown_to_original(os.path.join(sudo.get_home_dir(), ".thalamus"))
+    except Exception as e:
+        click.echo(click.style("Upgrade halted: ", fg="red", bold=True) + str(e))
+        click.echo(f"Step logs are in {sudo.log_dir}")
+        click.get_current_context().exit(1)
+    click.echo(click.style("Upgrade complete!", fg="green", bold=True))
+
+@main.command(help="Show the effective values of the host, kubelet, containerd and nginx tuning")
+def verify():
+    import socket
+    from thalamus.kubeclient import KubeClient
+    from thalamus.state import invoking_home_dir
+    from thalamus.tuning import Tuning, is_effective, read_containerd_config
+
+    kubelet_config = None
+    kube_config_path = os.path.join(invoking_home_dir(), ".kube", "config")
+    if os.path.exists(kube_config_path):
+        try:
+            with KubeClient(kube_config_path) as client:
+                names = [node["metadata"]["name"] for node in client.get("/api/v1/nodes")["items"]]
+                # k0s names the node after the lowercased hostname
+                name = socket.gethostname().lower()
+                if name not in names:
+                    name = names[0]
+                kubelet_config = client.get(f"/api/v1/nodes/{name}/proxy/configz")["kubeletconfig"]
+        except Exception as e:
+            click.echo(click.style("Warning: ", fg="yellow", bold=True) + f"Couldn't read the kubelet config: {e}")
+
+    results = Tuning(HostProfile.detect()).verify(kubelet_config, read_containerd_config())
+    click.echo(f"{'setting':<42} {'wanted':>14} {'effective':>14}")
+    mismatches = 0
+    for setting, wanted, effective in results:
+        ok = is_effective(wanted, effective)
+        mismatches += not ok
+        status = click.style("ok", fg="green") if ok else click.style("differs", fg="red")
+        click.echo(f"{setting:<42} {str(wanted):>14} {'?' if effective is None else str(effective):>14}  {status}")
+    if mismatches:
+        click.get_current_context().exit(1)
+
+@main.command(help="Load test the installed Cortex through nginx and save the results as JSON")
+@click.option("--rate", default=50.0, show_default=True, type=click.FloatRange(min=0, min_open=True), help="Requests per second sent to each host")
+@click.option("--duration", default=30.0, show_default=True, type=click.FloatRange(min=0, min_open=True), help="How long to send requests for, in seconds")
+@click.option("--connections", default=16, show_default=True, type=click.IntRange(min=1), help="Keepalive connections per host")
+@click.option("--timeout", default=10.0, show_default=True, type=click.FloatRange(min=0, min_open=True), help="Seconds before a request counts as an error")
+@click.option("--direct", is_flag=True, help="Send requests straight to the service IPs instead of through nginx")
+@click.option("--address", default="127.0.0.1", show_default=True, help="Address of the nginx front end")
+@click.option("--port", type=int, help="Port to connect to (default: 443 through nginx with TLS, otherwise 80)")
+@click.option("--frontend-path", default="/", show_default=True, help="Path to request from the frontend")
+@click.option("--backend-path", default="/", show_default=True, help="Path to request from the backend")
+@click.option("--insecure", is_flag=True, help="Don't verify the TLS certificate")
+@click.option("--output", help="Write the JSON results here (default: ~/.thalamus/bench/)", type=click.Path(dir_okay=False, writable=True))
+def bench(rate, duration, connections, timeout, direct, address, port, frontend_path, backend_path, insecure, output):
+    import datetime
+    import json
+    from thalamus.bench import format_results, run_benchmark
+    from thalamus.state import load_install_state, state_dir
+
+    try:
+        state = load_install_state()
+    except FileNotFoundError as e:
+        click.echo(click.style("Error: ", fg="red", bold=True) + str(e))
+        click.get_current_context().exit(1)
+
+    tls = state["protocol"] == "https" and not direct
+    if port is None:
+        port = 443 if tls else 80
+    targets = [
+        (state["frontend"], state["frontend_ip"] if direct else address, port, frontend_path),
+        (state["backend"], state["backend_ip"] if direct else address, port, backend_path),
+    ]
+    started = datetime.datetime.now()
+    click.echo(f"Sending {rate:g} requests/s to {state['frontend']} and {state['backend']} for {duration:g}s...")
+    results = run_benchmark(targets, rate, duration, connections, timeout, tls=tls, verify=not insecure)
+    click.echo(format_results(results))
+
+    if not output:
+        output = os.path.join(state_dir(), "bench", started.strftime("bench-%Y%m%d-%H%M%S.json"))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "started": started.isoformat(timespec="seconds"),
+            "settings": {
+                "rate": rate,
+                "duration": duration,
+                "connections": connections,
+                "timeout": timeout,
+                "direct": direct,
+                "tls": tls,
+            },
+            "results": results,
+        }, f, indent=2)
+    click.echo(f"Results written to {output}")
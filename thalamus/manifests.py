@@ -0,0 +1,97 @@
+import base64
+import io
+import json
+import os
+import tempfile
+from ruamel.yaml import YAML
+
+NAMESPACE = "default"
+LABELS = {"app.kubernetes.io/managed-by": "thalamus"}
+
+# API paths for the kinds the installer owns, and whether they live in a namespace
+RESOURCES = {
+    "Namespace": ("namespaces", False),
+    "ConfigMap": ("configmaps", True),
+    "Secret": ("secrets", True),
+}
+
+def metadata(name, namespace=NAMESPACE):
+    return {"name": name, "namespace": namespace, "labels": dict(LABELS)}
+
+def license_secret(license):
+    return {
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": metadata("cortex-secret"),
+        "type": "Opaque",
+        "stringData": {"ENTITLEMENTS_JWT": license}
+    }
+
+def registry_secret(user, github_token):
+    auth = base64.b64encode(f"{user}:{github_token}".encode("utf-8")).decode("utf-8")
+    docker_config = {
+        "auths": {
+            "ghcr.io": {
+                "username": user,
+                "password": github_token,
+                "email": "martindstone@me.com",
+                "auth": auth
+            }
+        }
+    }
+    return {
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": metadata("cortex-docker-registry-secret"),
+        "type": "kubernetes.io/dockerconfigjson",
+        "stringData": {".dockerconfigjson": json.dumps(docker_config)}
+    }
+
+def install_config(frontend, backend, protocol):
+    # a record in the cluster of how the installer set it up
+    return {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": metadata("thalamus-install"),
+        "data": {"frontend": frontend, "backend": backend, "protocol": protocol}
+    }
+
+def redact(obj):
+    # secret values never go to disk; the keys stay, so a saved copy still shows what was applied
+    if obj["kind"] != "Secret":
+        return obj
+    return dict(obj, **{
+        field: {key: "<redacted>" for key in obj[field]} for field in ("data", "stringData") if field in obj
+    })
+
+def resource_path(obj):
+    plural, namespaced = RESOURCES[obj["kind"]]
+    api_version = obj["apiVersion"]
+    prefix = f"/api/{api_version}" if "/" not in api_version else f"/apis/{api_version}"
+    if namespaced:
+        prefix += f"/namespaces/{obj['metadata'].get('namespace', NAMESPACE)}"
+    return f"{prefix}/{plural}/{obj['metadata']['name']}"
+
+class Manifest:
+    def __init__(self, objects=()):
+        self.objects = list(objects)
+
+    def add(self, obj):
+        self.objects.append(obj)
+        return self
+
+    def render(self, objects=None):
+        yaml = YAML(typ="safe")
+        yaml.default_flow_style = False
+        stream = io.StringIO()
+        yaml.dump_all(self.objects if objects is None else objects, stream)
+        return stream.getvalue()
+
+    def write(self, path):
+        # a copy for debugging, with the secret values left out; the objects themselves are applied from memory
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".manifest-")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.render([redact(obj) for obj in self.objects]))
+        os.replace(tmp_path, path)
+        return path
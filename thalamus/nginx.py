@@ -1,28 +1,116 @@
-def make_nginx_config(path, frontend_name, frontend_ip, backend_name, backend_ip):
-    config = f"""
-server {{
-    listen 80;
-    server_name {frontend_name};
-    location / {{
-        proxy_pass http://{frontend_ip};
+import os
+import re
+import subprocess
+import tempfile
+
+PROXY_SETTINGS = """
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
         proxy_set_header Host $host;
         proxy_set_header X-Real-IP $remote_addr;
         proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
         proxy_set_header X-Forwarded-Proto $scheme;
-    }}
-}}
+        proxy_connect_timeout 5s;
+        proxy_send_timeout {timeout};
+        proxy_read_timeout {timeout};
+        proxy_buffer_size 16k;
+        proxy_buffers 16 16k;
+        proxy_busy_buffers_size 32k;"""
 
+GZIP_SETTINGS = """
+    gzip on;
+    gzip_vary on;
+    gzip_proxied any;
+    gzip_comp_level 5;
+    gzip_min_length 1024;
+    gzip_types text/plain text/css application/javascript application/json image/svg+xml application/xml font/ttf;"""
+
+def write_file_atomic(path, content):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix="." + os.path.basename(path) + "-")
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+def write_validated(path, content):
+    # swap the new file in, and put the old one back if nginx doesn't accept it
+    previous = None
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            previous = f.read()
+    write_file_atomic(path, content)
+    try:
+        subprocess.check_output(["nginx", "-t"], stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        if previous is None:
+            os.remove(path)
+        else:
+            write_file_atomic(path, previous)
+        raise Exception("nginx rejected the new config: " + e.output.decode("utf-8"))
+
+def server_block(name, upstream, timeout, tls_cert=None, tls_key=None, gzip=False):
+    listen = "    listen 80;"
+    redirect = ""
+    if tls_cert and tls_key:
+        listen = f"""    listen 443 ssl http2;
+    ssl_certificate {tls_cert};
+    ssl_certificate_key {tls_key};
+    ssl_session_cache shared:SSL:10m;
+    ssl_session_timeout 1h;"""
+        redirect = f"""
 server {{
     listen 80;
-    server_name {backend_name};
+    server_name {name};
+    return 301 https://$host$request_uri;
+}}
+"""
+    return f"""{redirect}
+server {{
+{listen}
+    server_name {name};{GZIP_SETTINGS if gzip else ""}
     location / {{
-        proxy_pass http://{backend_ip};
-        proxy_set_header Host $host;
-        proxy_set_header X-Real-IP $remote_addr;
-        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-        proxy_set_header X-Forwarded-Proto $scheme;
+        proxy_pass http://{upstream};{PROXY_SETTINGS.format(timeout=timeout)}
     }}
 }}
 """
-    with open(path, "w") as f:
-        f.write(config)
+
+def render_nginx_config(frontend_name, frontend_ip, backend_name, backend_ip, tls_cert=None, tls_key=None):
+    # upstream blocks let nginx keep idle connections to the services open between requests
+    return f"""
+upstream cortex_frontend {{
+    server {frontend_ip}:80;
+    keepalive 32;
+}}
+
+upstream cortex_backend {{
+    server {backend_ip}:80;
+    keepalive 64;
+}}
+{server_block(frontend_name, "cortex_frontend", "60s", tls_cert, tls_key, gzip=True)}{server_block(backend_name, "cortex_backend", "300s", tls_cert, tls_key)}"""
+
+def make_nginx_config(path, frontend_name, frontend_ip, backend_name, backend_ip, tls_cert=None, tls_key=None):
+    config = render_nginx_config(frontend_name, frontend_ip, backend_name, backend_ip, tls_cert, tls_key)
+    write_validated(path, config)
+
+def tune_nginx_main_config(path, host):
+    # worker settings live in the main context of nginx.conf, so edit them in place
+    worker_connections = 1024 * min(8, max(1, host.cpus // 2))
+    with open(path, "r") as f:
+        config = f.read()
+    settings = [
+        (r"^\s*#?\s*worker_processes\s+[^;]*;", f"worker_processes {host.cpus};"),
+        # each proxied connection needs a descriptor for the client and one for the upstream
+        (r"^\s*#?\s*worker_rlimit_nofile\s+[^;]*;", f"worker_rlimit_nofile {worker_connections * 2};"),
+    ]
+    for pattern, line in settings:
+        if re.search(pattern, config, flags=re.MULTILINE):
+            config = re.sub(pattern, line, config, count=1, flags=re.MULTILINE)
+        else:
+            config = line + "\n" + config
+    config = re.sub(r"^(\s*)worker_connections\s+[^;]*;", rf"\g<1>worker_connections {worker_connections};", config, count=1, flags=re.MULTILINE)
+    config = re.sub(r"^(\s*)#\s*multi_accept\s+on;", r"\g<1>multi_accept on;", config, count=1, flags=re.MULTILINE)
+    write_validated(path, config)
+
+def reload_nginx():
+    # graceful reload keeps open connections; it falls back to a (re)start if nginx isn't running
+    subprocess.check_output(["systemctl", "reload-or-restart", "nginx"], stderr=subprocess.STDOUT)
@@ -0,0 +1,110 @@
+import json
+import socket
+import threading
+from concurrent.futures import Future
+
+class Preflight:
+    # per-check timeouts in seconds
+    timeouts = {
+        "external_ip": 10,
+        "dns": 5,
+        "github_pat": 15,
+        "license": 5,
+    }
+
+    def __init__(self, exported=None):
+        self.futures = {}
+        self.lock = threading.Lock()
+        # results exported by the process that ran before us (see export)
+        for key, value in json.loads(exported or "[]"):
+            self.remember(tuple(key), value)
+
+    def remember(self, key, value):
+        future = Future()
+        future.set_result(value)
+        with self.lock:
+            self.futures[key] = future
+
+    def is_remembered(self, key):
+        with self.lock:
+            future = self.futures.get(key)
+        return future is not None and future.done() and future.exception() is None
+
+    def export(self):
+        # successful results as JSON, so re-running under sudo doesn't repeat the checks
+        with self.lock:
+            items = list(self.futures.items())
+        return json.dumps([
+            [list(key), future.result()] for key, future in items if future.done() and future.exception() is None
+        ])
+
+    def run(self, key, fn, *args):
+        # start fn in the background unless it already succeeded or is still running;
+        # failed checks are retried so re-prompts with fixed input get a fresh lookup
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None or (future.done() and future.exception() is not None):
+                future = Future()
+                self.futures[key] = future
+                # daemon threads so a hung lookup can never keep the installer from exiting
+                threading.Thread(target=self.resolve, args=(future, fn, args), daemon=True).start()
+        return future
+
+    @staticmethod
+    def resolve(future, fn, args):
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def result(self, key, fn, *args):
+        return self.run((key,) + args, fn, *args).result(timeout=self.timeouts[key])
+
+    def start_external_ip(self):
+        return self.run(("external_ip",), self.get_external_ip)
+
+    def external_ip(self):
+        return self.result("external_ip", self.get_external_ip)
+
+    def start_resolve(self, hostname):
+        return self.run(("dns", hostname), socket.gethostbyname, hostname)
+
+    def resolve_hostname(self, hostname):
+        return self.result("dns", socket.gethostbyname, hostname)
+
+    def github_pat_is_valid(self, pat):
+        return self.result("github_pat", self.check_github_pat, pat)
+
+    def license_payload(self, license):
+        return self.result("license", self.decode_license, license)
+
+    def get_external_ip(self):
+        import requests
+        response = requests.get("https://api.ipify.org", timeout=self.timeouts["external_ip"])
+        response.raise_for_status()
+        if not response.text:
+            raise Exception("Failed to get external IP address")
+        return response.text.strip()
+
+    def check_github_pat(self, pat):
+        import requests
+        url = "https://api.github.com/orgs/cortexapps/packages/docker/cortex-onprem-backend"
+        headers = {
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"Bearer {pat}",
+            "X-GitHub-Api-Version": "2022-11-28"
+        }
+        response = requests.get(url, headers=headers, timeout=self.timeouts["github_pat"])
+        if response.status_code != 200 or response.json().get("package_type") != "container":
+            raise ValueError("Invalid GitHub PAT")
+        return True
+
+    def decode_license(self, license):
+        import jwt
+        headers = jwt.get_unverified_header(license)
+        if headers.get("typ") != "JWT":
+            raise ValueError("Invalid license key")
+        payload = jwt.decode(license, options={"verify_signature": False})
+        if not payload.get("entitlements"):
+            raise ValueError("Invalid license key")
+        return payload
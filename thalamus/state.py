@@ -0,0 +1,30 @@
+import json
+import os
+import pwd
+import tempfile
+
+def invoking_home_dir():
+    # under sudo, the state lives in the home of the user who ran sudo
+    uid = int(os.environ.get("SUDO_UID", os.getuid()))
+    return pwd.getpwuid(uid).pw_dir
+
+def state_dir(home_dir=None):
+    return os.path.join(home_dir or invoking_home_dir(), ".thalamus")
+
+def install_state_path(home_dir=None):
+    return os.path.join(state_dir(home_dir), "install.json")
+
+def load_install_state(home_dir=None):
+    path = install_state_path(home_dir)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No installation found at {path}; run install-cortex first")
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_install_state(state, home_dir=None):
+    path = install_state_path(home_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".install-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
@@ -1,17 +1,30 @@
 import click
 import os
+import re
 import sys
 import pwd
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from thalamus.utils import chown_tree, stream_command
 
 class Sudo:
     def __init__(self, **kwargs):
+        self.tracer = kwargs.get("tracer")
+        self.journal = kwargs.get("journal")
+        self.log_dir = kwargs.get("log_dir")
+        self.live_output = kwargs.get("live_output", False)
+        self.tail_lines = kwargs.get("tail_lines", 20)
         sudo = kwargs.get("sudo", True)
         if isinstance(sudo, bool):
             if sudo:
                 if os.geteuid() != 0 or os.environ.get("SUDO_UID") is None:
+                    # anything the user already entered is handed over in the environment
+                    env = kwargs.get("env", {})
+                    os.environ.update(env)
+                    preserve = ["--preserve-env=" + ",".join(env)] if env else []
                     print("Re-running with sudo... You may be prompted for your local user password.")
-                    os.execvp('sudo', ['sudo', 'python3'] + sys.argv)
+                    os.execvp('sudo', ['sudo'] + preserve + ['python3'] + sys.argv)
 
                 self.original_uid = int(os.environ.get("SUDO_UID"))
                 self.original_gid = int(os.environ.get("SUDO_GID"))
@@ -32,27 +45,69 @@ class Sudo:
     def get_original_cwd(self) -> str:
         return self.original_cwd
 
-    def chown_to_original(self, path):
+    def chown_to_original(self, path, workers=1):
         # recursively chown if it's a directory
-        if os.path.isdir(path):
-            for root, dirs, files in os.walk(path):
-                for d in dirs:
-                    os.chown(os.path.join(root, d), self.original_uid, self.original_gid)
-                for f in files:
-                    os.chown(os.path.join(root, f), self.original_uid, self.original_gid)
-        os.chown(path, self.original_uid, self.original_gid)
+        return chown_tree(path, self.original_uid, self.original_gid, workers=workers)
+
+    def get_log_path(self, step):
+        if self.log_dir is None:
+            return None
+        os.makedirs(self.log_dir, exist_ok=True)
+        name = step.get("name") or re.sub(r"[^A-Za-z0-9]+", "-", step["description"]).strip("-").lower()
+        return os.path.join(self.log_dir, name + ".log")
+
+    def run_command(self, step, record=None):
+        if isinstance(step["command"], str):
+            on_line = None
+            if self.live_output:
+                prefix = click.style(f"[{step.get('name', step['description'])}] ", dim=True)
+                on_line = lambda line: click.echo(prefix + line.decode("utf-8", errors="replace").rstrip())
+            output, output_bytes = stream_command(
+                step["command"], tail_lines=self.tail_lines, log_path=self.get_log_path(step), on_line=on_line
+            )
+            if record is not None:
+                record["exit_code"] = 0
+                record["output_bytes"] = output_bytes
+            return output
+        elif callable(step["command"]):
+            return step["command"]()
+
+    def run_step(self, step):
+        if self.tracer is None:
+            return self.run_command(step)
+        with self.tracer.span(step["description"]) as record:
+            return self.run_command(step, record)
+
+    def describe_error(self, e):
+        message = str(e)
+        if isinstance(e, subprocess.CalledProcessError) and e.output:
+            # the output only holds the last few lines, which is where the cause usually is
+            lines = e.output.decode("utf-8", errors="replace").rstrip().splitlines()
+            message += "\n" + "\n".join("    " + line for line in lines)
+        return message
+
+    def is_journaled(self, step):
+        return self.journal is not None and self.journal.is_journaled(step)
+
+    def echo_skipped(self, step):
+        click.echo(step["description"] + "... " + click.style("already done", fg="yellow"))
 
     def execute_step(self, step):
+        fingerprint = None
+        if self.is_journaled(step):
+            fingerprint = self.journal.fingerprint(step)
+            if self.journal.is_complete(step["name"], fingerprint):
+                self.echo_skipped(step)
+                return None
         click.echo(step["description"] + "... ", nl=False)
         result = None
         try:
-            if isinstance(step["command"], str):
-                result = subprocess.check_output(step["command"], shell=True, stderr=subprocess.STDOUT)
-            elif callable(step["command"]):
-                result = step["command"]()
+            result = self.run_step(step)
         except Exception as e:
-            click.echo(click.style("Error: ", fg="red", bold=True) + str(e))
+            click.echo(click.style("Error: ", fg="red", bold=True) + self.describe_error(e))
             raise
+        if fingerprint is not None:
+            self.journal.mark_complete(step["name"], fingerprint)
         click.echo(click.style("done", fg="green"))
         return result
 
@@ -61,3 +116,66 @@ class Sudo:
         for step in steps:
             results.append(self.execute_step(step))
         return results
+
+    def execute_step_graph(self, steps, max_workers=4):
+        # steps can have a "name" and a list of step names they "depend" on.
+        # steps whose dependencies are done run concurrently; each one prints
+        # "description... done" when it finishes, and the first failure stops
+        # any further steps from being started.
+        steps_by_name = {}
+        for step in steps:
+            name = step.get("name", step["description"])
+            if name in steps_by_name:
+                raise ValueError(f"Duplicate step name: {name}")
+            steps_by_name[name] = step
+        for name, step in steps_by_name.items():
+            for dependency in step.get("depends", []):
+                if dependency not in steps_by_name:
+                    raise ValueError(f"Step {name} depends on unknown step {dependency}")
+
+        results = {}
+        fingerprints = {}
+        pending = dict(steps_by_name)
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            while pending or running:
+                scheduled = True
+                while scheduled:
+                    scheduled = False
+                    for name, step in list(pending.items()):
+                        dependencies = step.get("depends", [])
+                        if not all(dependency in results for dependency in dependencies):
+                            continue
+                        del pending[name]
+                        scheduled = True
+                        if self.is_journaled(step):
+                            fingerprints[name] = self.journal.fingerprint(
+                                step, [fingerprints.get(dependency) for dependency in dependencies]
+                            )
+                            if self.journal.is_complete(name, fingerprints[name]):
+                                self.echo_skipped(step)
+                                results[name] = None
+                                continue
+                        running[executor.submit(self.run_step, step)] = name
+                if not running:
+                    if pending:
+                        raise ValueError("Step dependencies contain a cycle: " + ", ".join(pending))
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    click.echo(steps_by_name[name]["description"] + "... ", nl=False)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        click.echo(click.style("Error: ", fg="red", bold=True) + self.describe_error(e))
+                        raise
+                    if name in fingerprints:
+                        self.journal.mark_complete(name, fingerprints[name])
+                    click.echo(click.style("done", fg="green"))
+        finally:
+            # let steps that are already running finish, but don't start new ones
+            executor.shutdown(wait=True, cancel_futures=True)
+        return [results[step.get("name", step["description"])] for step in steps]
@@ -0,0 +1,76 @@
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class Tracer:
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.thread_ids = {}
+
+    @contextmanager
+    def span(self, name, category="step"):
+        # child CPU time is process-wide, so steps that overlap share each other's CPU time
+        record = {"name": name, "category": category, "status": "ok", "exit_code": None, "output_bytes": 0}
+        started = time.perf_counter()
+        cpu = children_cpu_time()
+        try:
+            yield record
+        except BaseException as e:
+            record["status"] = "error"
+            record["error"] = str(e)
+            if isinstance(e, subprocess.CalledProcessError):
+                record["exit_code"] = e.returncode
+                record["output_bytes"] = getattr(e, "output_bytes", len(e.output or b""))
+            raise
+        finally:
+            record["start"] = started - self.origin
+            record["duration"] = time.perf_counter() - started
+            record["child_cpu"] = children_cpu_time() - cpu
+            with self.lock:
+                record["thread"] = self.thread_ids.setdefault(threading.get_ident(), len(self.thread_ids))
+                self.records.append(record)
+
+    def report(self):
+        with self.lock:
+            records = sorted(self.records, key=lambda r: r["start"])
+        return {
+            "started_at": self.started_at,
+            "duration": time.perf_counter() - self.origin,
+            "steps": records,
+        }
+
+    def trace_events(self, records):
+        # Chrome trace-event format ("X" complete events, microseconds), loadable in Perfetto or chrome://tracing
+        pid = os.getpid()
+        return [
+            {
+                "name": r["name"],
+                "cat": r["category"],
+                "ph": "X",
+                "ts": int(r["start"] * 1e6),
+                "dur": int(r["duration"] * 1e6),
+                "pid": pid,
+                "tid": r["thread"],
+                "args": {k: r[k] for k in ("status", "exit_code", "output_bytes", "child_cpu") if r.get(k) is not None},
+            }
+            for r in records
+        ]
+
+    def write(self, path):
+        # one file holds both the step report and the trace events; trace viewers ignore the extra keys
+        report = self.report()
+        report["traceEvents"] = self.trace_events(report["steps"])
+        report["displayTimeUnit"] = "ms"
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
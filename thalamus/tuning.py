@@ -0,0 +1,138 @@
+import os
+import subprocess
+
+from thalamus.host import GIB, read_file
+from thalamus.nginx import write_file_atomic
+
+class Tuning:
+    k0s_config_path = "/etc/k0s/k0s.yaml"
+    containerd_config_path = "/etc/k0s/containerd.d/thalamus.toml"
+    sysctl_path = "/etc/sysctl.d/90-thalamus.conf"
+    modules_path = "/etc/modules-load.d/thalamus.conf"
+    nginx_limits_path = "/etc/systemd/system/nginx.service.d/thalamus.conf"
+    worker_profile = "thalamus"
+
+    def __init__(self, host):
+        self.host = host
+
+    def kubelet_settings(self):
+        # Cortex images are big, so pull them side by side and free space in larger steps
+        return {
+            "maxPods": min(250, max(110, self.host.cpus * 10)),
+            "serializeImagePulls": False,
+            "maxParallelImagePulls": min(10, max(4, self.host.cpus // 2)),
+            "imageGCHighThresholdPercent": 85,
+            "imageGCLowThresholdPercent": 70,
+        }
+
+    def containerd_settings(self):
+        return {
+            "max_concurrent_downloads": min(16, max(6, self.host.cpus)),
+        }
+
+    def nginx_nofile(self):
+        return 65536
+
+    def sysctls(self):
+        memory_gib = max(1, self.host.memory // GIB)
+        targets = {
+            "net.netfilter.nf_conntrack_max": min(1048576, max(262144, memory_gib * 16384)),
+            "net.core.somaxconn": 8192,
+            "net.ipv4.tcp_max_syn_backlog": 8192,
+            "fs.inotify.max_user_watches": 524288,
+            "fs.inotify.max_user_instances": 8192,
+            "fs.file-max": 2097152,
+        }
+        # these are minimums; a host that is already set higher keeps its value
+        settings = {}
+        for key, value in targets.items():
+            current = read_sysctl(key)
+            settings[key] = max(value, int(current)) if current and current.isdigit() else value
+        # the lower bound stays above the NodePort range (30000-32767), so outgoing connections
+        # never take a port a Service needs
+        settings["net.ipv4.ip_local_port_range"] = "32768 65000"
+        return settings
+
+    def render_k0s_config(self):
+        # k0s fills in the defaults for everything not set here
+        lines = [
+            "apiVersion: k0s.k0sproject.io/v1beta1",
+            "kind: ClusterConfig",
+            "metadata:",
+            "  name: k0s",
+            "spec:",
+            "  workerProfiles:",
+            f"  - name: {self.worker_profile}",
+            "    values:",
+        ]
+        for key, value in self.kubelet_settings().items():
+            lines.append(f"      {key}: {str(value).lower() if isinstance(value, bool) else value}")
+        return "\n".join(lines) + "\n"
+
+    def render_containerd_config(self):
+        # k0s merges drop-ins under containerd.d into the CRI plugin config it generates
+        settings = "\n".join(f"  {key} = {value}" for key, value in self.containerd_settings().items())
+        return f'version = 2\n\n[plugins."io.containerd.grpc.v1.cri"]\n{settings}\n'
+
+    def render_sysctl(self):
+        return "".join(f"{key} = {value}\n" for key, value in self.sysctls().items())
+
+    def render_nginx_limits(self):
+        return f"[Service]\nLimitNOFILE={self.nginx_nofile()}\n"
+
+    def write_k0s_config(self):
+        for path, content in (
+            (self.k0s_config_path, self.render_k0s_config()),
+            (self.containerd_config_path, self.render_containerd_config()),
+        ):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_file_atomic(path, content)
+
+    def tune_host(self):
+        # conntrack settings only exist once the module is loaded, so load it now and on every boot
+        write_file_atomic(self.modules_path, "nf_conntrack\n")
+        subprocess.check_output(["modprobe", "nf_conntrack"], stderr=subprocess.STDOUT)
+        write_file_atomic(self.sysctl_path, self.render_sysctl())
+        subprocess.check_output(["sysctl", "-p", self.sysctl_path], stderr=subprocess.STDOUT)
+        # nginx may not be installed yet; the drop-in is picked up when it is
+        os.makedirs(os.path.dirname(self.nginx_limits_path), exist_ok=True)
+        write_file_atomic(self.nginx_limits_path, self.render_nginx_limits())
+        subprocess.check_output(["systemctl", "daemon-reload"], stderr=subprocess.STDOUT)
+
+    def verify(self, kubelet_config=None, containerd_config=None):
+        # (setting, wanted, effective) for everything we tune; None means it couldn't be read
+        results = []
+        for key, value in self.sysctls().items():
+            current = read_sysctl(key)
+            results.append((key, value, " ".join(current.split()) if current else None))
+        for key, value in self.kubelet_settings().items():
+            results.append(("kubelet " + key, value, (kubelet_config or {}).get(key)))
+        for key, value in self.containerd_settings().items():
+            results.append(("containerd " + key, value, (containerd_config or {}).get(key)))
+        results.append(("nginx LimitNOFILE", self.nginx_nofile(), systemd_property("nginx", "LimitNOFILE")))
+        return results
+
+def read_sysctl(key):
+    return read_file("/proc/sys/" + key.replace(".", "/"))
+
+def systemd_property(unit, name):
+    result = subprocess.run(["systemctl", "show", unit, "--property", name, "--value"], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip() or None
+
+def read_containerd_config(path="/run/k0s/containerd-cri.toml"):
+    # the CRI config k0s generated from its defaults and our drop-in
+    settings = {}
+    for line in (read_file(path) or "").splitlines():
+        key, _, value = line.partition("=")
+        if value and key.strip() == "max_concurrent_downloads":
+            settings["max_concurrent_downloads"] = value.strip()
+    return settings
+
+def is_effective(wanted, effective):
+    if effective is None:
+        return False
+    if isinstance(wanted, bool):
+        return str(effective).lower() == str(wanted).lower()
+    return str(effective) == str(wanted)
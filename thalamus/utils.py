@@ -1,5 +1,111 @@
+import collections
+import os
+import stat
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
-def runcmd(cmd):
-    output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-    return output.decode("utf-8").strip()
+MAX_LINE_BYTES = 64 * 1024
+DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+
+def stream_command(cmd, tail_lines=20, log_path=None, on_line=None):
+    # run a shell command and read its output line by line, keeping only the last
+    # tail_lines lines in memory; returns (tail, total output size in bytes)
+    tail = collections.deque(maxlen=tail_lines)
+    output_bytes = 0
+    log = open(log_path, "wb") if log_path else None
+    try:
+        with subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
+            for line in iter(lambda: process.stdout.readline(MAX_LINE_BYTES), b""):
+                output_bytes += len(line)
+                tail.append(line)
+                if log:
+                    log.write(line)
+                if on_line:
+                    on_line(line)
+    finally:
+        if log:
+            log.close()
+    output = b"".join(tail)
+    if process.returncode:
+        error = subprocess.CalledProcessError(process.returncode, cmd, output=output)
+        error.output_bytes = output_bytes
+        raise error
+    return output, output_bytes
+
+def chown_entry(entry, dir_fd, uid, gid):
+    # returns (whether it was changed, whether it is a real directory); symlinks are never followed.
+    # other steps create and rename temp files while we walk, so entries that vanish are skipped
+    try:
+        st = entry.stat(follow_symlinks=False)
+        changed = st.st_uid != uid or st.st_gid != gid
+        if changed:
+            os.chown(entry.name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        return False, False
+    return changed, stat.S_ISDIR(st.st_mode)
+
+def open_subdir(name, dir_fd):
+    # None if the directory is gone, or was replaced by something else, since we listed it
+    try:
+        return os.open(name, DIR_FLAGS, dir_fd=dir_fd)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+def chown_subtree(fd, uid, gid):
+    # depth-first over directory fds, so only one fd per level is open and every
+    # chown is relative to its directory instead of a re-resolved path; closes fd
+    changed = 0
+    stack = [(fd, os.scandir(fd))]
+    try:
+        while stack:
+            dir_fd, entries = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                stack.pop()
+                entries.close()
+                os.close(dir_fd)
+                continue
+            entry_changed, is_dir = chown_entry(entry, dir_fd, uid, gid)
+            changed += entry_changed
+            child_fd = open_subdir(entry.name, dir_fd) if is_dir else None
+            if child_fd is not None:
+                stack.append((child_fd, os.scandir(child_fd)))
+    finally:
+        for dir_fd, entries in stack:
+            entries.close()
+            os.close(dir_fd)
+    return changed
+
+def chown_tree(path, uid, gid, workers=1):
+    # recursively chown path, skipping entries that already have the right owner;
+    # with workers > 1 the top-level subdirectories are done in parallel.
+    # returns the number of entries that were changed
+    st = os.lstat(path)
+    changed = 0
+    if st.st_uid != uid or st.st_gid != gid:
+        os.chown(path, uid, gid, follow_symlinks=False)
+        changed += 1
+    if not stat.S_ISDIR(st.st_mode):
+        return changed
+
+    root_fd = os.open(path, DIR_FLAGS)
+    if workers <= 1:
+        return changed + chown_subtree(root_fd, uid, gid)
+    try:
+        subdirs = []
+        with os.scandir(root_fd) as entries:
+            for entry in entries:
+                entry_changed, is_dir = chown_entry(entry, root_fd, uid, gid)
+                changed += entry_changed
+                if is_dir:
+                    subdirs.append(entry.name)
+
+        def chown_subdir(name):
+            fd = open_subdir(name, root_fd)
+            return 0 if fd is None else chown_subtree(fd, uid, gid)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            changed += sum(executor.map(chown_subdir, subdirs))
+    finally:
+        os.close(root_fd)
+    return changed
@@ -1,7 +1,65 @@
-from ruamel.yaml import YAML, RoundTripLoader, RoundTripDumper
+from ruamel.yaml import YAML
+from collections.abc import Mapping
+import copy
 import shutil
 import os
 import datetime
+import tempfile
+
+from thalamus.host import GIB, HostProfile
+
+MIB = 1024 * 1024
+
+# lists of dicts are merged item by item when every item has one of these keys
+MERGE_KEYS = ("name",)
+
+def find_merge_key(*lists):
+    items = [item for items in lists for item in items]
+    if not items or not all(isinstance(item, Mapping) for item in items):
+        return None
+    for key in MERGE_KEYS:
+        if all(key in item for item in items):
+            return key
+    return None
+
+def apply_overlay(values, overlay, changes=None, path=""):
+    # merge overlay into values in place; scalars and lists without a merge key are replaced.
+    # every change is appended to changes as (path, old value, new value)
+    for key, value in overlay.items():
+        key_path = f"{path}.{key}" if path else str(key)
+        existing = values.get(key)
+        if isinstance(value, Mapping) and isinstance(existing, Mapping):
+            apply_overlay(existing, value, changes, key_path)
+        elif isinstance(value, list) and isinstance(existing, list) and find_merge_key(existing, value):
+            merge_key = find_merge_key(existing, value)
+            by_key = {item[merge_key]: item for item in existing}
+            for item in value:
+                item_path = f"{key_path}[{merge_key}={item[merge_key]}]"
+                if item[merge_key] in by_key:
+                    apply_overlay(by_key[item[merge_key]], item, changes, item_path)
+                else:
+                    existing.append(copy.deepcopy(item))
+                    if changes is not None:
+                        changes.append((item_path, None, item))
+        elif key not in values or existing != value:
+            values[key] = copy.deepcopy(value)
+            if changes is not None:
+                changes.append((key_path, existing, value))
+    return values
+
+def diff_values(old, new, path=""):
+    # structural diff of two values trees as a list of (path, old value, new value)
+    changes = []
+    if isinstance(old, Mapping) and isinstance(new, Mapping):
+        for key in list(old.keys()) + [k for k in new.keys() if k not in old]:
+            key_path = f"{path}.{key}" if path else str(key)
+            changes.extend(diff_values(old.get(key), new.get(key), key_path))
+    elif old != new:
+        changes.append((path, old, new))
+    return changes
+
+def format_changes(changes):
+    return "\n".join(f"{path}: {old!r} -> {new!r}" for path, old, new in changes)
 
 class Values:
     def __init__(self):
@@ -25,41 +83,94 @@ class Values:
                 }
             }
         }
+        self.last_changes = []
 
     def get_values_template(self, template_name):
+        if template_name == "auto":
+            return self.auto_values_template(HostProfile.detect())
         return self.values_templates.get(template_name, {})
 
-    def edit_values_yaml(self, values_path, *updates):
-        def walk_update(values, update):
-            for key, value in update.items():
-                if isinstance(value, dict):
-                    if key in values:
-                        walk_update(values[key], value)
-                    else:
-                        values[key] = value
-                elif isinstance(value, list):
-                    # TODO: implement list update properly when lists of lists or dicts are involved
-                    values[key] = value
-                else:
-                    values[key] = value
-            return values
+    def auto_values_template(self, host):
+        # leave room for the OS, k0s, postgres and the frontend, then split the rest
+        # of the memory between the backend (two shares per replica) and the worker (one)
+        reserved = 2 * GIB + host.memory // 10
+        available = max(host.memory - reserved, 2 * GIB)
+        backend_replicas = min(4, max(1, host.cpus // 8))
+        worker_replicas = min(4, max(1, host.cpus // 16))
+        share = available / (2 * backend_replicas + worker_replicas)
+        cpus = max(0.5, host.cpus * 0.8 / (backend_replicas + worker_replicas))
+
+        template = copy.deepcopy(self.values_templates["demo"])
+        template["app"]["backend"] = self.jvm_component_values(backend_replicas, min(2 * share, 16 * GIB), cpus, host)
+        template["app"]["worker"] = self.jvm_component_values(worker_replicas, min(share, 8 * GIB), cpus, host)
+        return template
+
+    @staticmethod
+    def jvm_component_values(replicas, memory, cpus, host):
+        # heap is 3/4 of the container memory, as values.yaml recommends; JVMs with
+        # less CPU start more slowly, so they get more time before the probes start
+        memory_mib = int(memory // MIB)
+        max_heap = memory_mib * 3 // 4
+        min_heap = min(max_heap, max(512, max_heap // 4))
+        millicpus = int(cpus * 1000)
+        probe = {
+            "initialDelaySeconds": 60 if cpus >= 4 else 100 if cpus >= 2 else 180,
+            "periodSeconds": 10,
+            "timeoutSeconds": 6 if cpus >= 2 else 10,
+            "failureThreshold": 5,
+        }
+        return {
+            "replicaCount": replicas,
+            "jvmConfiguration": {
+                "javaOpts": f"-Xms{min_heap}m -Xmx{max_heap}m",
+            },
+            "containerConfiguration": {
+                "livenessProbe": dict(probe),
+                "readinessProbe": dict(probe),
+                "resources": {
+                    "requests": {"memory": f"{memory_mib}Mi", "cpu": f"{millicpus}m"},
+                    "limits": {"memory": f"{memory_mib}Mi", "cpu": f"{min(millicpus * 2, host.cpus * 1000)}m"},
+                },
+            },
+        }
 
+    def render_values_yaml(self, values_path, *updates):
         if not updates:
             raise ValueError("At least one values update is required")
         if not os.path.exists(values_path):
             raise FileNotFoundError(f"Values file not found: {values_path}")
         if not os.access(values_path, os.R_OK | os.W_OK):
             raise PermissionError(f"Cannot read/write file: {values_path}")
+
+        # fold all the updates together first, so the values file is only walked once
+        overlay = {}
+        for update in updates:
+            apply_overlay(overlay, update)
+
         yaml = YAML()
         with open(values_path, 'r') as f:
             values = yaml.load(f)
-        backup_path = values_path + datetime.datetime.now().strftime(".%Y%m%d%H%M%S.bak")
-        with open(backup_path, 'w') as f:
-            yaml.dump(values, f)
-        for update in updates:
-            # walk the values dict and update the values
-            values = walk_update(values, update)
+        self.last_changes = []
+        apply_overlay(values, overlay, self.last_changes)
+        return values
+
+    def edit_values_yaml(self, values_path, *updates):
+        values = self.render_values_yaml(values_path, *updates)
+        yaml = YAML()
 
-        with open(values_path, 'w') as f:
+        # the new file is written to a temp file and renamed, so a hardlink keeps the original as the backup
+        backup_path = values_path + datetime.datetime.now().strftime(".%Y%m%d%H%M%S.bak")
+        st = os.stat(values_path)
+        try:
+            os.link(values_path, backup_path)
+        except OSError:
+            shutil.copy2(values_path, backup_path)
+            os.chown(backup_path, st.st_uid, st.st_gid)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(values_path)), prefix=".values-")
+        with os.fdopen(fd, 'w') as f:
             yaml.dump(values, f)
-        return backup_path
\ No newline at end of file
+        # we run as root, but the file stays with whoever owned it
+        os.chown(tmp_path, st.st_uid, st.st_gid)
+        shutil.copymode(backup_path, tmp_path)
+        os.replace(tmp_path, values_path)
+        return backup_path
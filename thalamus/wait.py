@@ -0,0 +1,79 @@
+import ctypes
+import os
+import random
+import select
+import time
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+def wait_for(condition, timeout, initial_interval=0.25, max_interval=5, factor=2, jitter=0.2, ignore=(), description="condition"):
+    # call condition until it returns something truthy, backing off exponentially with jitter;
+    # exceptions of the types in ignore count as "not yet"
+    deadline = time.monotonic() + timeout
+    interval = initial_interval
+    last_error = None
+    while True:
+        try:
+            result = condition()
+            if result:
+                return result
+        except ignore as e:
+            last_error = e
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            message = f"Timed out after {timeout}s waiting for {description}"
+            if last_error is not None:
+                message += f": {last_error}"
+            raise TimeoutError(message)
+        time.sleep(min(remaining, interval * random.uniform(1 - jitter, 1 + jitter)))
+        interval = min(interval * factor, max_interval)
+
+def inotify_init():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None, None
+    if fd < 0:
+        return None, None
+    return libc, fd
+
+def file_is_ready(path):
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+def wait_for_file(path, timeout, description=None):
+    # block until path exists and is non-empty, woken by inotify instead of polling where possible
+    description = description or path
+    if file_is_ready(path):
+        return path
+    libc, fd = inotify_init()
+    if fd is None:
+        return wait_for(lambda: file_is_ready(path) and path, timeout, description=description)
+
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            # watch the closest directory that exists; it changes as parent directories get created
+            watched = os.path.dirname(os.path.abspath(path))
+            while not os.path.isdir(watched):
+                watched = os.path.dirname(watched)
+            libc.inotify_add_watch(fd, watched.encode(), IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ATTRIB)
+            if file_is_ready(path):
+                return path
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Timed out after {timeout}s waiting for {description}")
+            # wake up at least once a second in case an event was missed
+            readable, _, _ = select.select([fd], [], [], min(remaining, 1.0))
+            if readable:
+                try:
+                    os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    pass
+    finally:
+        os.close(fd)